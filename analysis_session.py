@@ -0,0 +1,48 @@
+import threading
+
+from rosdistro import get_cached_distribution, get_distribution_file, \
+    get_distribution_files, get_index, get_index_url
+
+from dependency_index import DependencyIndex
+
+
+class AnalysisSession:
+    # State shared by all analysers of one process, so that several distros
+    # can be analysed in one run: the rosdistro index is fetched once, and
+    # distribution files, distro caches and dependency indexes are kept per
+    # distro. Analysers put their own caches (package.xml cache, mirror pool,
+    # analysed source repositories, ...) in the session with shared().
+
+    def __init__(self, index_url=None):
+        self._index_url = index_url
+        self._shared = {}
+        self._lock = threading.RLock()
+
+    def shared(self, key, factory):
+        # the object stored under key, created with factory() on first use
+        with self._lock:
+            if key not in self._shared:
+                self._shared[key] = factory()
+            return self._shared[key]
+
+    def get_index(self):
+        return self.shared(('index',), lambda: get_index(
+            self._index_url or get_index_url()))
+
+    def get_distribution_files(self, distro):
+        return self.shared(('distribution_files', distro), lambda:
+                           get_distribution_files(self.get_index(), distro))
+
+    def get_distribution_file(self, distro):
+        return self.shared(('distribution_file', distro), lambda:
+                           get_distribution_file(self.get_index(), distro))
+
+    def get_distro(self, distro):
+        # what rosinstall_generator's get_distro returns, without fetching
+        # the index again
+        return self.shared(('distro', distro), lambda:
+                           get_cached_distribution(self.get_index(), distro))
+
+    def get_dependency_index(self, distro):
+        return self.shared(('dependency_index', distro), lambda:
+                           DependencyIndex(self.get_distro(distro)))
@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import random
+import sys
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict
+from contextlib import contextmanager
+from hashlib import sha1
+from os import devnull, makedirs, walk
+from os.path import dirname, isdir, join
+from shutil import rmtree
+from SocketServer import ThreadingMixIn
+from subprocess import check_call
+from sys import stdout
+from tempfile import mkdtemp
+from timeit import default_timer
+
+import xml.etree.ElementTree as ET
+
+from rosdistro.distribution import Distribution
+from rosdistro.distribution_file import DistributionFile
+
+from analysis_session import AnalysisSession
+from github_manager import github_manager
+from graph_render import render
+from migration_helper import Graph, migration_analyser
+from profiling import add_profile_argument, report_at_exit
+from rosdepend_graph import dependency_report_generator
+from rosdistro_analyser import (CacheAnalyser, _encode_repository, dictify,
+                                extract_package_xml)
+
+
+def load_package_xml_samples(paths):
+    # package.xml documents from source trees, and from the entries of a
+    # package.xml cache (rosdistro_analyser --xml-cache)
+    samples = []
+    for path in paths:
+        for root, dirs, files in walk(path):
+            for f in files:
+                if f == 'package.xml':
+                    with open(join(root, f), 'r') as fh:
+                        samples.append(fh.read())
+                elif f.endswith('.json'):
+                    with open(join(root, f), 'r') as fh:
+                        try:
+                            entry = json.load(fh)
+                        except ValueError:
+                            continue
+                    if isinstance(entry, dict) and 'xml' in entry:
+                        samples.append(entry['xml'])
+    return samples
+
+
+def time_per_sample(fn, samples, repeat):
+    # best of repeat runs over all samples, in seconds per sample
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        for s in samples:
+            fn(s)
+        t = default_timer() - start
+        best = t if best is None else min(best, t)
+    return best / len(samples)
+
+
+def benchmark_package_xml(args):
+    samples = load_package_xml_samples(args.paths)
+    if not samples:
+        raise SystemExit('no package.xml samples found in %s' % args.paths)
+
+    def dictified(xml):
+        return CacheAnalyser._extract_from_package_xml(
+            dictify(ET.fromstring(xml))['package'])
+
+    mismatches = 0
+    for s in samples:
+        try:
+            if dictified(s) != extract_package_xml(s):
+                mismatches += 1
+        except KeyError:
+            # empty elements the dictified document has no text for
+            pass
+
+    def safe(fn):
+        def run(xml):
+            try:
+                fn(xml)
+            except KeyError:
+                pass
+        return run
+
+    old = time_per_sample(safe(dictified), samples, args.repeat)
+    new = time_per_sample(extract_package_xml, samples, args.repeat)
+    return {
+        'samples': len(samples),
+        'mismatches': mismatches,
+        'dictify_us': old * 1e6,
+        'extract_us': new * 1e6,
+        'speedup': old / new
+    }
+
+
+# synthetic distributions, workspaces and GitHub organisations, generated
+# for the suite below so it runs without network access
+
+SYNTHETIC_PACKAGE_XML = '''<?xml version="1.0"?>
+<package format="2">
+  <name>%(name)s</name>
+  <version>1.0.0</version>
+  <description>Synthetic package %(name)s of repository %(repo)s.</description>
+  <maintainer email="maintainer@example.com">Maintainer of %(repo)s</maintainer>
+  <author>Author of %(repo)s</author>
+  <license>BSD</license>
+  <url type="website">https://example.com/%(repo)s</url>
+  <buildtool_depend>catkin</buildtool_depend>
+%(depends)s</package>
+'''
+# dependencies outside of the synthetic distribution
+SYNTHETIC_EXTERNAL_DEPENDS = ['roscpp', 'rospy', 'std_msgs']
+SYNTHETIC_ORGANISATION = 'benchmark'
+# a repository without any commits in the synthetic organisation
+SYNTHETIC_EMPTY_REPO = 'empty_repo'
+
+
+def synthetic_packages(packages, packages_per_repo, depends, seed):
+    # repository -> {package: package.xml}. Packages only depend on packages
+    # generated before them, so the repository graph is acyclic.
+    rnd = random.Random(seed)
+    repos = defaultdict(dict)
+    for i in range(packages):
+        name = 'pkg_%05d' % i
+        repo = 'repo_%05d' % (i // packages_per_repo)
+        deps = set(rnd.sample(range(i), min(i, depends)))
+        deps = ['pkg_%05d' % d for d in sorted(deps)]
+        deps.append(rnd.choice(SYNTHETIC_EXTERNAL_DEPENDS))
+        repos[repo][name] = SYNTHETIC_PACKAGE_XML % {
+            'name': name,
+            'repo': repo,
+            'depends': ''.join(['  <depend>%s</depend>\n' % d for d in deps])
+        }
+    return repos
+
+
+def _write_file(path, text):
+    if not isdir(dirname(path)):
+        makedirs(dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def _git(cwd, *args):
+    check_call(('git', '-c', 'user.name=benchmark',
+                '-c', 'user.email=benchmark@example.com') + args,
+               cwd=cwd, stdout=open(devnull, 'w'))
+
+
+def synthetic_distribution(repos, source_repos, git_dir):
+    # distribution file data: all repositories are released, except those
+    # in source_repos, which only have a source entry pointing to a local
+    # git repository created in git_dir
+    data = {
+        'type': 'distribution',
+        'version': 2,
+        'release_platforms': {'ubuntu': ['xenial']},
+        'tags': ['lcas'],
+        'repositories': {}
+    }
+    for repo, pkgs in repos.items():
+        url = 'https://github.com/%s/%s.git' % (SYNTHETIC_ORGANISATION, repo)
+        if repo in source_repos:
+            path = join(git_dir, repo)
+            for p, xml in pkgs.items():
+                _write_file(join(path, p, 'package.xml'), xml)
+            _git(path, 'init', '-q')
+            _git(path, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+            _git(path, 'add', '.')
+            _git(path, 'commit', '-q', '-m', 'synthetic packages')
+            url = 'file://' + path
+        entry = {'source': {'type': 'git', 'url': url, 'version': 'master',
+                            'test_commits': True}}
+        if repo not in source_repos:
+            entry['release'] = {
+                'packages': sorted(pkgs),
+                'tags': {'release': 'release/benchmark/{package}/{version}'},
+                'url': 'https://github.com/%s/%s-release.git' % (
+                    SYNTHETIC_ORGANISATION, repo),
+                'version': '1.0.0-0'
+            }
+        data['repositories'][repo] = entry
+    return data
+
+
+def synthetic_workspace(repos, workspace):
+    for repo, pkgs in repos.items():
+        for p, xml in pkgs.items():
+            _write_file(join(workspace, 'src', repo, p, 'package.xml'), xml)
+
+
+class SyntheticSession(AnalysisSession):
+    # serves a synthetic distribution file, and the release package.xml
+    # files of its packages, instead of fetching the rosdistro index
+
+    def __init__(self, data, package_xmls):
+        AnalysisSession.__init__(self)
+        self._data = data
+        self._package_xmls = package_xmls
+
+    def get_index(self):
+        return None
+
+    def get_distribution_files(self, distro):
+        return [self.get_distribution_file(distro)]
+
+    def get_distribution_file(self, distro):
+        return self.shared(('distribution_file', distro), lambda:
+                           DistributionFile(distro, self._data))
+
+    def get_distro(self, distro):
+        return self.shared(('distro', distro), lambda: Distribution(
+            self.get_distribution_file(distro),
+            manifest_providers=[
+                lambda dist, repo, pkg: self._package_xmls.get(pkg)],
+            source_manifest_providers=[]))
+
+
+class _GitHubStubHandler(BaseHTTPRequestHandler):
+    # the GitHub GraphQL and blob endpoints and the Jenkins job pages
+    # github_manager uses, answered from the synthetic packages
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body='', content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_POST(self):
+        query = json.loads(self.rfile.read(
+            int(self.headers.getheader('Content-Length'))))
+        names = self.server.repo_names
+        start = int(query['variables'].get('cursor') or 0)
+        end = min(start + 100, len(names))
+        nodes = []
+        for repo in names[start:end]:
+            if repo not in self.server.repos:
+                # empty repositories have no default branch
+                nodes.append({
+                    'name': repo,
+                    'url': 'https://github.com/%s/%s' % (
+                        SYNTHETIC_ORGANISATION, repo),
+                    'defaultBranchRef': None
+                })
+                continue
+            nodes.append({
+                'name': repo,
+                'url': 'https://github.com/%s/%s' % (
+                    SYNTHETIC_ORGANISATION, repo),
+                'defaultBranchRef': {'name': 'master', 'target': {'tree': {
+                    'entries': [{
+                        'name': p,
+                        'type': 'tree',
+                        'oid': sha1(p).hexdigest(),
+                        'object': {'entries': [{
+                            'name': 'package.xml',
+                            'type': 'blob',
+                            'oid': sha1(xml).hexdigest()}]}
+                    } for p, xml in sorted(self.server.repos[repo].items())]
+                }}}
+            })
+        self._reply(200, json.dumps({'data': {'repositoryOwner': {
+            'repositories': {
+                'pageInfo': {'hasNextPage': end < len(names),
+                             'endCursor': str(end)},
+                'nodes': nodes}}}}))
+
+    def do_GET(self):
+        sha = self.path.rsplit('/', 1)[-1]
+        if '/git/blobs/' in self.path and sha in self.server.blobs:
+            self._reply(200, self.server.blobs[sha], 'text/plain')
+        else:
+            self._reply(404)
+
+    def do_HEAD(self):
+        # every other repository has a Jenkins job
+        repo = self.path.rsplit('-', 1)[-1]
+        if '/jenkins/job/' in self.path and repo in self.server.repos:
+            self._reply(200 if int(repo.rsplit('_', 1)[-1]) % 2 else 404,
+                        '', 'text/html')
+        else:
+            self._reply(404)
+
+
+class GitHubStub(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    # the default backlog of 5 makes concurrent clients wait for SYN
+    # retransmits
+    request_queue_size = 128
+
+    def __init__(self, repos):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _GitHubStubHandler)
+        self.repos = repos
+        self.repo_names = sorted(repos) + [SYNTHETIC_EMPTY_REPO]
+        self.blobs = dict([
+            (sha1(xml).hexdigest(), xml)
+            for pkgs in repos.values() for xml in pkgs.values()])
+        self.url = 'http://127.0.0.1:%d' % self.server_port
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+@contextmanager
+def timed(stages, name):
+    # the wall time of the block, in seconds, and nothing it prints
+    out = sys.stdout
+    sys.stdout = open(devnull, 'w')
+    start = default_timer()
+    try:
+        yield
+    finally:
+        stages[name] = default_timer() - start
+        sys.stdout.close()
+        sys.stdout = out
+
+
+def benchmark_analyser(stages, session, distro, work_dir, args):
+    with timed(stages, 'analyser.dependency_index'):
+        session.get_dependency_index(distro).resolve(
+            session.get_distribution_file(distro).release_packages)
+    ca = CacheAnalyser(distro=distro, jobs=args.jobs, session=session)
+    # includes the dependency pass, which is timed on its own below
+    with timed(stages, 'analyser.analysis'):
+        ca._analyse_repos()
+    with timed(stages, 'analyser.dependency_pass'):
+        ca._analyse_deps()
+    with timed(stages, 'analyser.graph'):
+        dot = ca.generate_graph()
+    with timed(stages, 'analyser.markdown'):
+        ca.generate_markdown_repos()
+    if args.layout:
+        with timed(stages, 'analyser.layout'):
+            render(dot, join(work_dir, 'repos'), ['svg'])
+
+    # the snapshot must survive a round trip, including the packages of
+    # unreleased source repositories
+    if not any([pkg['status'] == 'source' for pkg in ca._pkgs.values()]):
+        raise RuntimeError('no source repository in the snapshot')
+    snapshot = join(work_dir, 'snapshot')
+    with timed(stages, 'analyser.write_snapshot'):
+        ca.write(snapshot)
+    loaded = CacheAnalyser(distro=distro, jobs=args.jobs, session=session)
+    with timed(stages, 'analyser.load_snapshot'):
+        loaded.load(snapshot)
+    for r in set(ca._repositories) | set(loaded._repositories):
+        if (r not in ca._repositories or r not in loaded._repositories or
+                _encode_repository(ca._repositories[r]) !=
+                _encode_repository(loaded._repositories[r])):
+            raise RuntimeError('repository %s differs after loading the '
+                               'snapshot' % r)
+
+
+def benchmark_migration(stages, session, distro):
+    with timed(stages, 'migration.analysis'):
+        ma = migration_analyser(distro, session=session)
+    graph = Graph()
+    for p, pkg in ma._our_packages.items():
+        for d in pkg['deps']:
+            graph.addEdge(d, p)
+    with timed(stages, 'migration.topological_sort'):
+        graph.topologicalSort()
+    with timed(stages, 'migration.cycles'):
+        graph.findCycles()
+
+    # the synthetic distribution is acyclic, but packages depend on packages
+    # of their own repository, so the repository graph has self loops that
+    # must not keep any repository out of the order
+    repo_graph = Graph()
+    for p, pkg in ma._our_packages.items():
+        for d in pkg['deps']:
+            repo_graph.addEdge(ma._our_packages[d]['repository'],
+                               pkg['repository'])
+    order, level = repo_graph.topologicalSort()
+    if len(order) != len(repo_graph.vertices()) or repo_graph.findCycles():
+        raise RuntimeError('repository order is incomplete: %d of %d '
+                           'repositories ordered' % (
+                               len(order), len(repo_graph.vertices())))
+
+
+def benchmark_workspace(stages, session, distro, repos, work_dir, args):
+    workspace = join(work_dir, 'workspace')
+    synthetic_workspace(repos, workspace)
+    with timed(stages, 'workspace.scan'):
+        dependency_report_generator(workspace, distro, session)
+    with timed(stages, 'workspace.rescan'):
+        drg = dependency_report_generator(workspace, distro, session)
+    with timed(stages, 'workspace.repo_graph'):
+        dot = drg.generate_repo_dep_graph()
+    with timed(stages, 'workspace.pkg_graph'):
+        drg.generate_pkg_dep_graph(between_repos=sorted(repos)[:10])
+    with timed(stages, 'workspace.markdown'):
+        drg.generate_markdown()
+    if args.layout:
+        with timed(stages, 'workspace.layout'):
+            render(dot, join(work_dir, 'workspace-repos'), ['svg'])
+
+
+def benchmark_github(stages, distro, repos, work_dir, args):
+    stub = GitHubStub(repos)
+    try:
+        gm = github_manager(argparse.Namespace(
+            user=None, token='benchmark', jobs=args.http_jobs, timeout=10,
+            discovery='tree', graphql=True,
+            graphql_url=stub.url + '/graphql', http_cache=None))
+        gm._api_url = stub.url
+        gm._jenkins_prefix = stub.url + '/jenkins/'
+        gm._ros_dist = [distro]
+        with timed(stages, 'github.checkout'):
+            gm.checkout_all_package_xml(
+                SYNTHETIC_ORGANISATION, join(work_dir, 'checkout'))
+        with timed(stages, 'github.html_report'):
+            gm.generate_html_report(SYNTHETIC_ORGANISATION)
+    finally:
+        stub.shutdown()
+        stub.server_close()
+
+
+def benchmark_suite(args):
+    runs = []
+    distro = 'benchmark'
+    for size in args.sizes:
+        work_dir = mkdtemp(prefix='benchmark-')
+        try:
+            repos = synthetic_packages(
+                size, args.packages_per_repo, args.depends, args.seed)
+            # the last repositories are not released, so nothing released
+            # depends on them
+            names = sorted(repos)
+            source_repos = set(
+                names[len(names) - int(len(names) * args.source_fraction):])
+            stages = {}
+            with timed(stages, 'setup'):
+                data = synthetic_distribution(
+                    repos, source_repos, join(work_dir, 'git'))
+                package_xmls = dict([
+                    (p, xml) for r, pkgs in repos.items()
+                    if r not in source_repos for p, xml in pkgs.items()])
+            session = SyntheticSession(data, package_xmls)
+            if 'analyser' in args.components:
+                benchmark_analyser(stages, session, distro, work_dir, args)
+            if 'migration' in args.components:
+                benchmark_migration(stages, session, distro)
+            if 'workspace' in args.components:
+                benchmark_workspace(
+                    stages, session, distro, repos, work_dir, args)
+            if 'github' in args.components:
+                benchmark_github(stages, distro, repos, work_dir, args)
+            runs.append({
+                'packages': size,
+                'repositories': len(repos),
+                'source_repositories': len(source_repos),
+                'stages': stages
+            })
+        finally:
+            rmtree(work_dir)
+    return {
+        'parameters': {
+            'packages_per_repo': args.packages_per_repo,
+            'depends': args.depends,
+            'source_fraction': args.source_fraction,
+            'seed': args.seed,
+            'jobs': args.jobs,
+            'http_jobs': args.http_jobs
+        },
+        'python': sys.version.split()[0],
+        'runs': runs
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='micro-benchmarks of the analysers')
+    subparsers = parser.add_subparsers()
+
+    p = subparsers.add_parser(
+        'package-xml',
+        help='compare dictify and extract_package_xml on package.xml '
+             'samples')
+    p.add_argument('paths', nargs='+',
+                   help='directories to collect package.xml files and '
+                        'package.xml cache entries from')
+    p.add_argument('--repeat', type=int, default=5,
+                   help='runs over all samples, the fastest counts')
+    p.set_defaults(func=benchmark_package_xml)
+
+    p = subparsers.add_parser(
+        'suite',
+        help='time every stage of the analysers on synthetic '
+             'distributions, workspaces and GitHub organisations')
+    p.add_argument('--sizes', type=int, nargs='+',
+                   default=[100, 1000, 10000],
+                   help='numbers of packages to generate')
+    p.add_argument('--packages-per-repo', type=int, default=5)
+    p.add_argument('--depends', type=int, default=3,
+                   help='dependencies of every package on other packages')
+    p.add_argument('--source-fraction', type=float, default=0.05,
+                   help='fraction of repositories that are not released, '
+                        'but only available as (local) source repositories')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--components', nargs='+',
+                   choices=['analyser', 'migration', 'workspace', 'github'],
+                   default=['analyser', 'migration', 'workspace', 'github'])
+    p.add_argument('--jobs', type=int, default=1,
+                   help='concurrent repository analyses')
+    p.add_argument('--http-jobs', type=int, default=8,
+                   help='concurrent requests to the GitHub and Jenkins stub')
+    p.add_argument('--no-layout', dest='layout', action='store_false',
+                   help='do not lay out and render the repository graphs')
+    p.set_defaults(func=benchmark_suite)
+
+    parser.add_argument('--output', '-o', default=None,
+                        help='file to write the JSON results to, default: '
+                             'stdout')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    report_at_exit(args.profile_report)
+    result = args.func(args)
+    out = open(args.output, 'w') if args.output else stdout
+    json.dump(result, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+from rosdistro.dependency_walker import DependencyWalker
+
+from profiling import profiler
+
+# the same dependency types rosinstall_generator's
+# get_recursive_dependencies follows
+DEPENDENCY_TYPES = ['buildtool', 'buildtool_export', 'build', 'build_export',
+                    'run', 'test']
+
+
+class DependencyIndex:
+    # index of the direct ROS package dependencies of release packages, i.e.
+    # what get_recursive_dependencies(distro, [p], limit_depth=1) returns.
+    # Each package.xml is still parsed once, as it was by those calls. What
+    # is saved is the set of release package names: the walker rebuilds it
+    # for every get_depends call, six times per package, which made
+    # resolving a whole distro quadratic in its size. Here it is built once.
+
+    def __init__(self, distro, package_names=[]):
+        # no condition context, like get_recursive_dependencies: conditional
+        # dependencies are all kept
+        self._walker = DependencyWalker(distro)
+        self._release_names = set(distro.release_packages)
+        self._deps = {}
+        self._errors = {}
+        self.resolve(package_names)
+
+    @profiler.timed('dependency_index.resolve')
+    def resolve(self, package_names):
+        for p in package_names:
+            if p in self._deps or p in self._errors:
+                continue
+            try:
+                deps = set([])
+                for t in DEPENDENCY_TYPES:
+                    deps |= self._walker._get_dependencies(p, t)
+                deps &= self._release_names
+                deps.discard(p)
+                self._deps[p] = deps
+            except AssertionError as e:
+                # remembered and raised on lookup, so a broken package only
+                # affects whoever asks for it
+                self._errors[p] = RuntimeError(
+                    "Failed to fetch recursive dependencies of package "
+                    "'%s': %s" % (p, e))
+            except Exception as e:
+                self._errors[p] = e
+
+    def get(self, package_name):
+        if package_name not in self._deps and package_name not in self._errors:
+            self.resolve([package_name])
+        if package_name in self._errors:
+            raise self._errors[package_name]
+        return self._deps[package_name]
+
+    def __contains__(self, package_name):
+        return package_name in self._deps
+
+    def items(self):
+        return self._deps.items()
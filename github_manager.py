@@ -5,14 +5,309 @@ from github3.repos.contents import Contents
 from getpass import getpass
 import os
 import argparse
+import json
 import yaml
 import requests
+import sys
+import threading
 import time
 
+from base64 import b64encode, b64decode
+from collections import defaultdict
+from hashlib import sha1
+from tempfile import mkstemp
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
 from subprocess import Popen, CalledProcessError
 
 from rosdistro import get_distribution_file, get_index, get_index_url
 
+from profiling import profiler, add_profile_argument, report_at_exit
+
+
+class request_scheduler:
+    # Hooks into the requests session used for all GitHub API calls and
+    # tracks the rate limit budget from the X-RateLimit-* response headers.
+    # Once the budget is used up, requests wait for the reset instead of
+    # failing with 403. Secondary rate limits are retried after backing
+    # off. map() runs work at the highest concurrency the remaining budget
+    # allows.
+
+    _reserve = 10  # requests kept back from the budget
+    _max_retries = 5
+    _secondary_backoff = 60  # seconds, doubled on every retry
+
+    def __init__(self, session, max_workers):
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        # while the budget is used up, all requests wait until then
+        self._blocked_until = None
+        self.counters = defaultdict(int)
+        self._send = session.request
+        session.request = self.request
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _wait_for_budget(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                delay = None
+                if self._blocked_until is not None:
+                    if now < self._blocked_until:
+                        delay = self._blocked_until - now
+                    else:
+                        # the window has been reset, the whole budget is
+                        # available again
+                        self._blocked_until = None
+                        self.remaining = self.limit
+                if delay is None:
+                    if self.remaining is None or self.remaining > self._reserve:
+                        if self.remaining is not None:
+                            # account for requests in flight in other threads
+                            self.remaining -= 1
+                        return
+                    self._blocked_until = self.reset + 1
+                    delay = self._blocked_until - now
+            self._count('budget_waits')
+            time.sleep(max(0, delay))
+
+    def _update(self, response):
+        h = response.headers
+        if 'X-RateLimit-Remaining' not in h:
+            return
+        with self._lock:
+            self.limit = int(h['X-RateLimit-Limit'])
+            self.remaining = int(h['X-RateLimit-Remaining'])
+            self.reset = int(h['X-RateLimit-Reset'])
+
+    def _backoff(self, response, attempt):
+        # seconds to wait before retrying, or None if there is no need to
+        if response.status_code not in (403, 429):
+            return None
+        h = response.headers
+        if 'Retry-After' in h:
+            self._count('secondary_limits')
+            return int(h['Retry-After'])
+        if h.get('X-RateLimit-Remaining') == '0':
+            self._count('primary_limits')
+            return max(0, int(h['X-RateLimit-Reset']) - time.time()) + 1
+        if 'secondary rate limit' in response.text.lower():
+            self._count('secondary_limits')
+            return self._secondary_backoff * 2 ** attempt
+        return None
+
+    def request(self, method, url, *args, **kwargs):
+        for attempt in range(self._max_retries + 1):
+            self._wait_for_budget()
+            with profiler.stage('github.request'):
+                response = self._send(method, url, *args, **kwargs)
+            if not kwargs.get('stream'):
+                profiler.add_bytes('github.request', len(response.content))
+            self._count('requests')
+            self._update(response)
+            delay = self._backoff(response, attempt)
+            if delay is None or attempt == self._max_retries:
+                return response
+            self._count('retries')
+            time.sleep(delay)
+
+    def concurrency(self):
+        with self._lock:
+            remaining = self.remaining
+        if remaining is None:
+            return self._max_workers
+        return max(1, min(self._max_workers, remaining - self._reserve))
+
+    def map(self, func, items):
+        items = list(items)
+        pool = ThreadPool(max(1, min(self.concurrency(), len(items))))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def stats(self):
+        res = dict(self.counters)
+        res.update({
+            'limit': self.limit,
+            'remaining': self.remaining,
+            'reset': self.reset
+        })
+        return res
+
+
+class http_cache:
+    # Persistent cache of GitHub API GET responses, hooked into the requests
+    # session like request_scheduler. Cached responses are revalidated with
+    # If-None-Match/If-Modified-Since; GitHub answers 304 if nothing changed
+    # and does not count that against the rate limit.
+
+    def __init__(self, session, cache_dir):
+        self._session = session
+        self._cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+        self._send = session.request
+        session.request = self.request
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _path(self, url, params, headers):
+        # responses differ per user, so the credentials are part of the key
+        key = json.dumps([
+            url,
+            sorted((params or {}).items()),
+            CaseInsensitiveDict(headers or {}).get(
+                'Accept', self._session.headers.get('Accept')),
+            self._session.headers.get('Authorization'),
+            repr(self._session.auth)
+        ])
+        return os.path.join(self._cache_dir, sha1(key).hexdigest() + '.json')
+
+    def _load(self, path):
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        # header names are stored in whatever case the server sent them
+        entry['headers'] = CaseInsensitiveDict(entry['headers'])
+        return entry
+
+    def _store(self, path, response):
+        fd, tmp_path = mkstemp(dir=self._cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'url': response.url,
+                'headers': dict(response.headers),
+                'content': b64encode(response.content)
+            }, f)
+        os.rename(tmp_path, path)
+
+    def _cached_response(self, entry, response):
+        cached = requests.Response()
+        cached.status_code = 200
+        cached.reason = 'OK'
+        cached.url = entry['url']
+        cached.request = response.request
+        cached.headers = CaseInsensitiveDict(entry['headers'])
+        # keep the live rate limit information of the 304
+        for k, v in response.headers.items():
+            if k.lower().startswith('x-ratelimit'):
+                cached.headers[k] = v
+        cached.encoding = get_encoding_from_headers(cached.headers)
+        cached._content = b64decode(entry['content'])
+        return cached
+
+    def request(self, method, url, *args, **kwargs):
+        if method.upper() != 'GET' or args or kwargs.get('stream'):
+            return self._send(method, url, *args, **kwargs)
+        path = self._path(url, kwargs.get('params'), kwargs.get('headers'))
+        entry = self._load(path)
+        if entry:
+            headers = dict(kwargs.get('headers') or {})
+            if 'ETag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['ETag']
+            if 'Last-Modified' in entry['headers']:
+                headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+            kwargs['headers'] = headers
+        response = self._send(method, url, **kwargs)
+        if response.status_code == 304 and entry:
+            self._count('hits')
+            profiler.cache('github_http_cache', True)
+            return self._cached_response(entry, response)
+        self._count('misses')
+        profiler.cache('github_http_cache', False)
+        if response.status_code == 200 and (
+                'ETag' in response.headers
+                or 'Last-Modified' in response.headers):
+            self._store(path, response)
+        return response
+
+    def stats(self):
+        return dict(self.counters)
+
+
+# repository filters of iter_repos that the GraphQL API can express
+GRAPHQL_FILTERS = {
+    'all': {},
+    'public': {'privacy': 'PUBLIC'},
+    'private': {'privacy': 'PRIVATE'},
+    'forks': {'isFork': True},
+    'sources': {'isFork': False}
+}
+
+# name, url, default branch and the top two levels of the default branch
+# tree (enough to find package.xml files up to depth 1) of 100 repositories
+GRAPHQL_REPOS_QUERY = '''
+query($login: String!, $cursor: String, $privacy: RepositoryPrivacy,
+      $isFork: Boolean) {
+  repositoryOwner(login: $login) {
+    repositories(first: 100, after: $cursor, privacy: $privacy,
+                 isFork: $isFork) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        name
+        url
+        defaultBranchRef {
+          name
+          target {
+            ... on Commit {
+              tree {
+                entries {
+                  name
+                  type
+                  oid
+                  object { ... on Tree { entries { name type oid } } }
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+
+class graphql_repo:
+    # the attributes of a github3 repository the subcommands use, plus the
+    # package.xml files found in the tree returned by GRAPHQL_REPOS_QUERY
+
+    def __init__(self, owner, node):
+        self.owner = owner
+        self.name = node['name']
+        self.html_url = node['url']
+        branch = node['defaultBranchRef'] or {}
+        self.default_branch = branch.get('name')
+        # (path, blob sha) of all package.xml files
+        self.package_xmls = []
+        tree = ((branch.get('target') or {}).get('tree') or {})
+        for e in tree.get('entries', []):
+            if e['type'] == 'blob' and e['name'] == 'package.xml':
+                self.package_xmls.append((str(e['name']), str(e['oid'])))
+            if e['type'] == 'tree' and e['object']:
+                for se in e['object'].get('entries', []):
+                    if se['type'] == 'blob' and se['name'] == 'package.xml':
+                        self.package_xmls.append((
+                            str(e['name'] + '/' + se['name']),
+                            str(se['oid'])))
+
 
 class github_manager:
 
@@ -22,6 +317,11 @@ class github_manager:
     __distribution = None
     _jenkins_prefix = 'http://lcas.lincoln.ac.uk/jenkins/'
     _ros_dist = ['hydro', 'indigo']
+    _jobs = 8
+    _timeout = 10
+    _discovery = 'tree'
+    _api_url = 'https://api.github.com'
+    _graphql_url = _api_url + '/graphql'
 
     @staticmethod
     def config_argparse(parser):
@@ -29,12 +329,39 @@ class github_manager:
                             help='the github user name', default=None)
         parser.add_argument('--token',
                             help='the github user name', default=None)
+        parser.add_argument('--jobs', type=int,
+                            help='number of concurrent HTTP requests',
+                            default=github_manager._jobs)
+        parser.add_argument('--timeout', type=float,
+                            help='timeout of HTTP requests in seconds',
+                            default=github_manager._timeout)
+        parser.add_argument('--discovery', choices=['tree', 'contents'],
+                            help='find package.xml files using one git '
+                                 'tree request per repository, or by '
+                                 'walking the directory contents',
+                            default=github_manager._discovery)
+        parser.add_argument('--graphql', action='store_true',
+                            help='list repositories and their package.xml '
+                                 'files with one GraphQL query per 100 '
+                                 'repositories')
+        parser.add_argument('--graphql-url',
+                            help='GraphQL endpoint to query',
+                            default=github_manager._graphql_url)
+        parser.add_argument('--http-cache',
+                            help='directory to cache GitHub API responses '
+                                 'in, for conditional requests',
+                            default=None)
+        parser.add_argument('--rate-stats', action='store_true',
+                            help='print GitHub rate limit counters to stderr '
+                                 'at exit')
+        add_profile_argument(parser)
 
     # can also be used like this:
     # tags = call(
     #             repo_path,
     #             ('git', 'tag', '-l', 'debian/*'),
     #              pipe=subprocess.PIPE)
+    @profiler.timed('github_manager.call')
     def call(self, working_dir, command, pipe=None):
         print('+ cd %s && ' % working_dir + ' '.join(command))
         if not self.pretend:
@@ -64,6 +391,19 @@ class github_manager:
 
 
     def __init__(self, args):
+        self._jobs = args.jobs
+        self._timeout = args.timeout
+        self._discovery = args.discovery
+        self._graphql = args.graphql
+        self._graphql_url = args.graphql_url
+        # one keep-alive connection pool shared by all worker threads
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self._jobs,
+                              pool_maxsize=self._jobs)
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+        self._jenkins_jobs = {}
+
         if args.user is not None:
             self._user = args.user
             while not self.__password:
@@ -72,25 +412,79 @@ class github_manager:
                 )
 
             self._gh = login(args.user, password=self.__password)
-            return
-        if args.token is not None:
+        elif args.token is not None:
             self._gh = login(token=args.token)
-            return
-        raise Exception('neither user name nor token succeeded')
+        else:
+            raise Exception('neither user name nor token succeeded')
+        # one connection pool, large enough for all worker threads
+        adapter = HTTPAdapter(pool_connections=self._jobs,
+                              pool_maxsize=self._jobs)
+        self._gh._session.mount('https://', adapter)
+        self._gh._session.mount('http://', adapter)
+        self._scheduler = request_scheduler(self._gh._session, self._jobs)
+        self._http_cache = None
+        if args.http_cache:
+            # on top of the scheduler, so 304s are still accounted for
+            self._http_cache = http_cache(self._gh._session, args.http_cache)
 
     def jenkins_job_url(self, repo_name, ros_distro):
         return self._jenkins_prefix+'job/'+'devel-'+ros_distro+'-'+repo_name
 
     def jenkins_job_exists(self, repo_name, ros_distro):
-        r = requests.get(self.jenkins_job_url(repo_name, ros_distro))
-        return r.status_code == 200
+        url = self.jenkins_job_url(repo_name, ros_distro)
+        profiler.cache('jenkins_jobs', url in self._jenkins_jobs)
+        if url not in self._jenkins_jobs:
+            try:
+                with profiler.stage('jenkins.head'):
+                    r = self._http.head(url, timeout=self._timeout,
+                                        allow_redirects=True)
+                self._jenkins_jobs[url] = r.status_code == 200
+            except requests.RequestException:
+                self._jenkins_jobs[url] = False
+        return self._jenkins_jobs[url]
+
+    @profiler.timed('github.graphql')
+    def query_repos_graphql(self, owner, filter='all'):
+        repos = []
+        variables = dict(GRAPHQL_FILTERS[filter])
+        variables.update({'login': owner, 'cursor': None})
+        while True:
+            r = self._gh._session.post(
+                self._graphql_url,
+                data=json.dumps({'query': GRAPHQL_REPOS_QUERY,
+                                 'variables': variables}),
+                timeout=self._timeout)
+            r.raise_for_status()
+            doc = r.json()
+            if doc.get('errors'):
+                raise Exception('GraphQL query failed: ' + '; '.join(
+                    [e['message'] for e in doc['errors']]))
+            if not doc['data']['repositoryOwner']:
+                raise Exception('no such organisation or user: ' + owner)
+            page = doc['data']['repositoryOwner']['repositories']
+            repos.extend([graphql_repo(owner, n) for n in page['nodes']])
+            if not page['pageInfo']['hasNextPage']:
+                return repos
+            variables['cursor'] = page['pageInfo']['endCursor']
+
+    def _iter_repos(self, organisation=None, filter='all'):
+        if (self._graphql and organisation is not None
+                and filter in GRAPHQL_FILTERS):
+            return self.query_repos_graphql(organisation, filter)
+        if organisation is not None:
+            org = self._gh.organization(organisation)
+        else:
+            org = self._gh
+        return org.iter_repos(filter)
 
     def query_orga_repos(self, organisation, filter='all'):
-        org = self._gh.organization(organisation)
-        repos = org.iter_repos(filter)
+        repos = self._iter_repos(organisation, filter)
 
         rosinstall = []
         for r in repos:
+            if not r.default_branch:
+                # empty repository, nothing to check out
+                continue
             entry = {'git': {'local-name': str(r.name),
                              'uri': str(r.html_url),
                              'version': str(r.default_branch)}}
@@ -113,32 +507,95 @@ class github_manager:
             return res
         return []
 
-    def get_package_xmls_from_repo(self, repo, depth):
+    @profiler.timed('github.tree')
+    def _search_tree_blobs(self, repo, max_depth, fname):
+        # finds fname in the recursive git tree of the default branch, which
+        # is a single API request regardless of max_depth. Returns a list of
+        # (path, blob sha), or None if GitHub truncated the tree.
+        url = repo._build_url('git', 'trees', repo.default_branch,
+                              base_url=repo._api)
+        r = repo._get(url, params={'recursive': '1'})
+        if r.status_code != 200:  # e.g. empty repository
+            return []
+        tree = r.json()
+        if tree.get('truncated'):
+            return None
+        return [(str(e['path']), str(e['sha'])) for e in tree['tree']
+                if e['type'] == 'blob'
+                and os.path.basename(e['path']) == fname
+                and e['path'].count('/') <= max_depth]
+
+    def get_package_xml_blobs_from_repo(self, repo, depth):
+        # like get_package_xmls_from_repo, but returns (path, blob sha)
+        # pairs; the sha is None where only the path is known
+        if isinstance(repo, graphql_repo):
+            if depth <= 1:
+                return list(repo.package_xmls)
+            repo = self._gh.repository(repo.owner, repo.name)
+        if self._discovery == 'tree':
+            res = self._search_tree_blobs(repo, depth, 'package.xml')
+            if res is not None:
+                return res
         top_level_content = repo.contents('/')
-        return self.search_file(repo, top_level_content,
-                                0, depth, 'package.xml')
+        return [(path, None) for path in self.search_file(
+            repo, top_level_content, 0, depth, 'package.xml')]
+
+    def get_package_xmls_from_repo(self, repo, depth):
+        return [path for path, sha in
+                self.get_package_xml_blobs_from_repo(repo, depth)]
 
     def get_package_xmls(self, organisation, depth):
-        org = self._gh.organization(organisation)
-        repos = org.iter_repos('all')
+        repos = self._iter_repos(organisation, 'all')
 
+        repos = list(repos)
+        pxmls = self._scheduler.map(
+            lambda r: self.get_package_xmls_from_repo(r, depth), repos)
         res = {}
-        for r in repos:
+        for r, pxml in zip(repos, pxmls):
             print r.name
             k = str(r.name)
-            res[k] = self.get_package_xmls_from_repo(r, depth)
+            res[k] = pxml
             print res[k]
         return res
 
+    def _repo_api_url(self, repo):
+        if isinstance(repo, graphql_repo):
+            return '%s/repos/%s/%s' % (self._api_url, repo.owner, repo.name)
+        return repo._api
+
+    @profiler.timed('github.read_file')
+    def _read_text_file(self, repo, fname, sha=None):
+        # blobs are addressed by content, everything else by path on the
+        # default branch
+        if sha is not None:
+            url = '%s/git/blobs/%s' % (self._repo_api_url(repo), sha)
+            params = None
+        elif isinstance(repo, graphql_repo):
+            url = '%s/contents/%s' % (self._repo_api_url(repo), fname)
+            params = {'ref': repo.default_branch}
+        else:
+            return repo.contents(fname).decoded
+        r = self._gh._session.get(
+            url, params=params,
+            headers={'Accept': 'application/vnd.github.v3.raw'},
+            timeout=self._timeout)
+        r.raise_for_status()
+        return r.content
+
+    def _write_text_file(self, text, fname, dest_dir='.'):
+        dn = os.path.join(dest_dir, os.path.dirname(fname))
+        try:
+            os.makedirs(dn)
+        except OSError:
+            if not os.path.isdir(dn):
+                raise
+        with open(os.path.join(dest_dir, fname), "w") as text_file:
+            text_file.write(text)
+
     def _checkout_text_files(self, repo, files_list, dest_dir='.'):
         for fname in files_list:
-            c = repo.contents(fname)
-
-            dn = os.path.join(dest_dir, os.path.dirname(c.path))
-            if not os.path.exists(dn):
-                os.makedirs(dn)
-            with open(os.path.join(dest_dir, fname), "w") as text_file:
-                text_file.write(c.decoded)
+            text = self._read_text_file(repo, fname)
+            self._write_text_file(text, fname, dest_dir)
 
     def generate_app_token(self,
                            note='github_manager',
@@ -156,17 +613,40 @@ class github_manager:
 
     def checkout_package_xml(self, repo, workspace):
         pxml = self.get_package_xmls_from_repo(repo, 1)
-        ghm._checkout_text_files(repo, pxml, workspace)
+        self._checkout_text_files(repo, pxml, workspace)
 
+    @profiler.timed('github.checkout')
     def checkout_all_package_xml(self, orga, workspace, filter='all'):
-        org = self._gh.organization(orga)
-        repos = org.iter_repos(filter)
-        for repo in repos:
+        # Pipelined over one bounded worker pool: a discovery task per
+        # repository queues one download-and-write task per package.xml as
+        # soon as its tree is known, so downloads of one repository overlap
+        # with the discovery of the next ones.
+        pool = ThreadPool(self._scheduler.concurrency())
+        lock = threading.Lock()
+        downloads = []
+
+        def download(repo, path, sha):
+            self._write_text_file(self._read_text_file(repo, path, sha), path,
+                                  os.path.join(workspace, repo.name))
+
+        def discover(repo):
             print "checking out package.xmls from repository " + repo.name
-            pxml = ghm.get_package_xmls_from_repo(repo, 1)
-            ghm._checkout_text_files(repo, pxml,
-                                     os.path.join(workspace, repo.name))
-            time.sleep(0.2)
+            blobs = self.get_package_xml_blobs_from_repo(repo, 1)
+            with lock:
+                downloads.extend([pool.apply_async(download, (repo,) + b)
+                                  for b in blobs])
+
+        try:
+            discoveries = [pool.apply_async(discover, (repo,))
+                           for repo in self._iter_repos(orga, filter)]
+            for d in discoveries:
+                d.get()
+            # all downloads are queued once every discovery has finished
+            for d in downloads:
+                d.get()
+        finally:
+            pool.close()
+            pool.join()
 
     def create_repo(
         self,
@@ -207,28 +687,45 @@ class github_manager:
                 repo.add_collaborator(o)
             #, 'description', 'homepage', 'private', 'has_issues','has_wiki', 'has_downloads']
 
-    def generate_html_report(self, organisation=None, filter='all'):
-        if organisation is not None:
-            org = self._gh.organization(organisation)
-        else:
-            org = self._gh
-        repos = org.iter_repos(filter)
-        out = '<html><body><table>'
-        for repo in repos:
-            out += '<tr>'
-            out += '<td><a href="' + str(repo.html_url) + '">' + repo.name + '</a></td>'
-            out += '<td>' + repo.default_branch + '</td>'
-            for rd in self._ros_dist:
-                if self.jenkins_job_exists(str(repo.name), rd):
-                    url = str(self.jenkins_job_url(str(repo.name), rd))
-                    out += '<td><a href="' + url + '">'
-                    out += '<img src="'+url+'/badge/icon"></a></td>'
-                else:
-                    out += '<td>---</td>'
-            out += '</tr>'
-        out += '</table></body></html>'
+    def _html_report_row(self, repo):
+        out = '<tr>'
+        out += '<td><a href="' + str(repo.html_url) + '">' + repo.name + '</a></td>'
+        out += '<td>' + (repo.default_branch or '(empty)') + '</td>'
+        for rd in self._ros_dist:
+            if self.jenkins_job_exists(str(repo.name), rd):
+                url = str(self.jenkins_job_url(str(repo.name), rd))
+                out += '<td><a href="' + url + '">'
+                out += '<img src="'+url+'/badge/icon"></a></td>'
+            else:
+                out += '<td>---</td>'
+        out += '</tr>'
         return out
 
+    def iter_html_report(self, organisation=None, filter='all'):
+        # yields the report piece by piece; rows are built concurrently
+        # (probing the Jenkins jobs) but yielded in repository order as soon
+        # as they are ready
+        yield '<html><body><table>'
+        pool = ThreadPool(self._jobs)
+        try:
+            for row in pool.imap(self._html_report_row,
+                                 self._iter_repos(organisation, filter)):
+                yield row
+        finally:
+            pool.close()
+            pool.join()
+        yield '</table></body></html>'
+
+    @profiler.timed('github.html_report')
+    def write_html_report(self, out, organisation=None, filter='all'):
+        for chunk in self.iter_html_report(organisation, filter):
+            out.write(chunk)
+            out.flush()
+
+    @profiler.timed('github.html_report')
+    def generate_html_report(self, organisation=None, filter='all'):
+        return ''.join(self.iter_html_report(organisation, filter))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -303,6 +800,7 @@ if __name__ == "__main__":
 
     github_manager.config_argparse(parser)
     args = parser.parse_args()
+    report_at_exit(args.profile_report)
     ghm = github_manager(args)
     if args.command == 'gen-token':
         token = ghm.generate_app_token(
@@ -326,5 +824,12 @@ if __name__ == "__main__":
             args.description)
 
     if args.command == 'report':
-        report = ghm.generate_html_report(args.organisation)
-        print report
+        ghm.write_html_report(sys.stdout, args.organisation)
+        print
+
+    if args.rate_stats:
+        stats = ghm._scheduler.stats()
+        if ghm._http_cache:
+            stats.update(dict([('http_cache_' + k, v) for k, v
+                               in ghm._http_cache.stats().items()]))
+        sys.stderr.write(yaml.dump(stats, default_flow_style=False))
@@ -0,0 +1,80 @@
+import json
+from hashlib import sha1
+from os.path import exists
+from subprocess import Popen, CalledProcessError
+
+from profiling import profiler
+
+
+def graph_hash(dot):
+    # canonical hash of a graph: nodes, edges, subgraphs and all their
+    # attributes, independent of the order they were added in
+    def canonical(g):
+        return {
+            'name': g.name,
+            'directed': g.directed,
+            'strict': g.strict,
+            'graph': sorted(g.graph_attr.items()),
+            'node': sorted(g.node_attr.items()),
+            'edge': sorted(g.edge_attr.items()),
+            'nodes': sorted([
+                (n, sorted(n.attr.items())) for n in g.nodes()]),
+            'edges': sorted([
+                (e[0], e[1], e.name, sorted(e.attr.items()))
+                for e in g.edges()]),
+            'subgraphs': sorted([
+                json.dumps(canonical(sg), sort_keys=True)
+                for sg in g.subgraphs()])
+        }
+    return sha1(json.dumps(canonical(dot), sort_keys=True)).hexdigest()
+
+
+def render(dot, basename, formats, prog='dot'):
+    # Lays the graph out once and renders all formats from the positioned
+    # graph, each one in its own renderer process running in parallel.
+    # "neato -n2" keeps the node and edge positions of the layout as they
+    # are, so the renderers do no layout work of their own.
+    #
+    # The positioned graph is kept in <basename>.layout.dot, and the hash of
+    # the graph it was computed from, along with the formats rendered from
+    # it, in <basename>.graph-hash. If the graph has not changed, the layout
+    # is skipped and only formats not rendered yet are rendered.
+    layout_file = basename + '.layout.dot'
+    hash_file = basename + '.graph-hash'
+    key = '%s %s' % (prog, graph_hash(dot))
+    outputs = dict([(fmt, '%s.%s' % (basename, fmt)) for fmt in formats])
+
+    cached = False
+    rendered = []
+    if exists(hash_file) and exists(layout_file):
+        with open(hash_file, 'r') as f:
+            try:
+                stamp = json.load(f)
+            except ValueError:
+                stamp = {}
+        cached = stamp.get('key') == key
+        if cached:
+            rendered = [fmt for fmt in stamp['formats']
+                        if exists('%s.%s' % (basename, fmt))]
+    profiler.cache('graph_layout', cached)
+    if not cached:
+        with profiler.stage('render.layout'):
+            dot.layout(prog=prog)
+            with open(layout_file, 'w') as f:
+                f.write(dot.string())
+
+    todo = [fmt for fmt in formats if fmt not in rendered]
+    with profiler.stage('render.draw'):
+        procs = [
+            Popen(['neato', '-n2', '-T' + fmt, '-o', outputs[fmt],
+                   layout_file])
+            for fmt in todo
+        ]
+        for p in procs:
+            p.wait()
+    for p in procs:
+        if p.returncode:
+            raise CalledProcessError(p.returncode, 'neato -n2')
+    with open(hash_file, 'w') as f:
+        json.dump({'key': key, 'formats': sorted(set(rendered + todo))}, f)
+    return sorted(outputs.values())
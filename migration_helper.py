@@ -6,51 +6,109 @@ import os
 from pprint import pprint
 import pygraphviz as pgv
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from rosinstall_generator.distro import get_distro, get_package_names
-from rosinstall_generator.distro import get_recursive_dependencies, get_release_tag
+from rosinstall_generator.distro import get_release_tag
 from rosdistro import get_distribution_files, get_index, get_index_url
 
+from analysis_session import AnalysisSession
+from profiling import profiler, add_profile_argument, report_at_exit
+
 class Graph: 
     def __init__(self): 
         self.graph = defaultdict(set) #dictionary containing adjacency List 
         #self.V = vertices #No. of vertices 
   
-    # function to add an edge to graph 
+    # function to add an edge to graph; self loops (e.g. dependencies
+    # between packages of the same repository) only add the vertex, as they
+    # do not constrain the order
     def addEdge(self,u,v): 
+        if u == v:
+            self.graph[u]
+            return
         self.graph[u].add(v) 
+
+    # all vertices, including those that only appear as edge targets
+    def vertices(self):
+        vertices = set(self.graph)
+        for adjacent in self.graph.values():
+            vertices.update(adjacent)
+        return vertices
   
-    # A recursive function used by topologicalSort 
-    def topologicalSortUtil(self,v,visited,stack, level): 
-  
-        # Mark the current node as visited. 
-        visited[v] = level
-        # Recur for all the vertices adjacent to this vertex 
-        if v in self.graph:
-            for i in self.graph[v]: 
-                if visited[i] < 0: 
-                    self.topologicalSortUtil(i,visited,stack, level + 1) 
-  
-        # Push current vertex to stack which stores result 
-        stack.insert(0,v) 
-  
-    # The function to do Topological Sort. It uses recursive  
-    # topologicalSortUtil() 
+    # Topological Sort using Kahn's algorithm, iterative and O(V+E).
+    # Returns the order and the level of every vertex, which is the length of
+    # the longest path leading to it (roots are level 1), so all vertices of
+    # one level can be migrated in the same wave. Vertices on or behind a
+    # cycle cannot be ordered and are left out, see findCycles().
+    @profiler.timed('migration.topological_sort')
     def topologicalSort(self): 
-        # Mark all the vertices as not visited 
-        visited = defaultdict(lambda: -1)
-        #for v in self.graph: 
-        #    visited[v] = False
-        stack =[] 
-  
-        # Call the recursive helper function to store Topological 
-        # Sort starting from all vertices one by one 
-        for i in self.graph: 
-            if visited[i] < 0 and i in self.graph: 
-                self.topologicalSortUtil(i,visited,stack,1) 
-  
-        # Print contents of stack 
-        return stack , visited
+        in_degree = defaultdict(int)
+        for u in self.graph:
+            for v in self.graph[u]:
+                in_degree[v] += 1
+
+        level = {}
+        queue = deque()
+        for v in self.vertices():
+            if in_degree[v] == 0:
+                level[v] = 1
+                queue.append(v)
+
+        order = []
+        while queue:
+            u = queue.popleft()
+            order.append(u)
+            for v in self.graph.get(u, ()):
+                level[v] = max(level.get(v, 0), level[u] + 1)
+                in_degree[v] -= 1
+                if in_degree[v] == 0:
+                    queue.append(v)
+
+        return order, dict([(v, level[v]) for v in order])
+
+    # Strongly connected components with more than one vertex, using an
+    # iterative version of Tarjan's algorithm, O(V+E).
+    @profiler.timed('migration.cycles')
+    def findCycles(self):
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        for root in self.vertices():
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.graph.get(root, ())))]
+            while work:
+                v, successors = work[-1]
+                for w in successors:
+                    if w not in index:
+                        index[w] = low[w] = len(index)
+                        stack.append(w)
+                        on_stack.add(w)
+                        work.append((w, iter(self.graph.get(w, ()))))
+                        break
+                    elif w in on_stack:
+                        low[v] = min(low[v], index[w])
+                else:
+                    work.pop()
+                    if work:
+                        u = work[-1][0]
+                        low[u] = min(low[u], low[v])
+                    if low[v] == index[v]:
+                        component = []
+                        while True:
+                            w = stack.pop()
+                            on_stack.discard(w)
+                            component.append(w)
+                            if w == v:
+                                break
+                        if len(component) > 1:
+                            cycles.append(component)
+        return cycles
 
 
 class migration_analyser:
@@ -58,23 +116,27 @@ class migration_analyser:
     _index = None
     _distribution = None
 
-    def __init__(self, distro='kinetic', tags=['lcas']):
-        self._index = get_index(get_index_url())
-        self._distributions = get_distribution_files(self._index, distro)
+    @profiler.timed('migration.analysis')
+    def __init__(self, distro='kinetic', tags=['lcas'], session=None):
+        session = session if session else AnalysisSession()
+        self._index = session.get_index()
+        self._distributions = session.get_distribution_files(distro)
         self._distribution = None
         for d in self._distributions:
             if set(d.tags).intersection(set(tags)):
                 self._distribution = d
                 break
-        self._ri_dist = get_distro(distro)
+        self._ri_dist = session.get_distro(distro)
         
         self._our_packages = {}
 
         release_packages_set = set(self._distribution.release_packages)
         pkg_dep_graph = Graph()
         rep_dep_graph = Graph()
+        dependency_index = session.get_dependency_index(distro)
+        dependency_index.resolve(release_packages_set)
         for p in release_packages_set:
-            deps = get_recursive_dependencies(self._ri_dist, [p], limit_depth=1)
+            deps = dependency_index.get(p)
             e = {
                 'name': p,
                 'deps': deps.intersection(release_packages_set),  # only keep the ones in our repo file
@@ -91,6 +153,8 @@ class migration_analyser:
         #pprint(g.graph)
         pkg_topo, pkg_level = pkg_dep_graph.topologicalSort()
         rep_topo, rep_level = rep_dep_graph.topologicalSort()
+        for c in rep_dep_graph.findCycles():
+            print('cyclic dependency between repositories: %s' % ', '.join(c))
         #pprint(rep_topo)
         #pprint(pkg_level)
 
@@ -254,6 +318,11 @@ def main_old():
 
 
 def main():
+    parser = argparse.ArgumentParser(description='order the repositories of a distro for migration')
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    report_at_exit(args.profile_report)
+
     drg = migration_analyser()
     #pprint(drg._our_packages)
     
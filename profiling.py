@@ -0,0 +1,104 @@
+import atexit
+import json
+import sys
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+
+
+class Profiler:
+    # Process-wide record of where the time goes: wall time, calls and
+    # bytes transferred per stage, plus hits and misses per cache. Safe to
+    # use from worker threads; the time of a stage is summed over all
+    # threads that ran it, so concurrent stages can add up to more than
+    # the elapsed time.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = default_timer()
+        self._stages = defaultdict(lambda: {'calls': 0, 'time': 0.0,
+                                            'bytes': 0})
+        self._caches = defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    @contextmanager
+    def stage(self, name):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            elapsed = default_timer() - start
+            with self._lock:
+                s = self._stages[name]
+                s['calls'] += 1
+                s['time'] += elapsed
+
+    def timed(self, name):
+        # decorator running the whole function as one stage
+        def decorate(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def add_bytes(self, name, n):
+        with self._lock:
+            self._stages[name]['bytes'] += n
+
+    def cache(self, name, hit):
+        with self._lock:
+            self._caches[name]['hits' if hit else 'misses'] += 1
+
+    def report(self):
+        with self._lock:
+            stages = dict([(k, dict(v)) for k, v in self._stages.items()])
+            caches = dict([(k, dict(v)) for k, v in self._caches.items()])
+        for c in caches.values():
+            lookups = c['hits'] + c['misses']
+            c['hit_rate'] = float(c['hits']) / lookups if lookups else None
+        return {
+            'elapsed': default_timer() - self._start,
+            'stages': stages,
+            'caches': caches
+        }
+
+    def write_report(self, out, fmt='table'):
+        report = self.report()
+        if fmt == 'json':
+            json.dump(report, out, indent=2, sort_keys=True)
+            out.write('\n')
+            return
+        out.write('%-40s %8s %10s %12s\n' % ('stage', 'calls', 'time [s]',
+                                              'bytes'))
+        for name, s in sorted(report['stages'].items(),
+                              key=lambda i: -i[1]['time']):
+            out.write('%-40s %8d %10.3f %12d\n' % (
+                name, s['calls'], s['time'], s['bytes']))
+        if report['caches']:
+            out.write('\n%-40s %8s %10s %12s\n' % ('cache', 'hits', 'misses',
+                                                   'hit rate'))
+            for name, c in sorted(report['caches'].items()):
+                out.write('%-40s %8d %10d %12s\n' % (
+                    name, c['hits'], c['misses'],
+                    '%.1f%%' % (100 * c['hit_rate'])
+                    if c['hit_rate'] is not None else '-'))
+        out.write('\n%-40s %30.3f\n' % ('elapsed [s]', report['elapsed']))
+
+
+profiler = Profiler()
+
+
+def add_profile_argument(parser):
+    parser.add_argument('--profile-report', nargs='?', const='table',
+                        choices=['table', 'json'], default=None,
+                        help='print per-stage timings, call and byte counts '
+                             'and cache hit rates to stderr at exit, as a '
+                             'table or as JSON')
+
+
+def report_at_exit(fmt, out=sys.stderr):
+    if fmt:
+        atexit.register(profiler.write_report, out, fmt)
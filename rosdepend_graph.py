@@ -1,11 +1,13 @@
-from catkin_pkg import topological_order
-
 import argparse
 import os
+import sys
 
 import pygraphviz as pgv
 
-from rosdistro import get_distribution_file, get_index, get_index_url
+from analysis_session import AnalysisSession
+from graph_render import render
+from profiling import profiler, add_profile_argument, report_at_exit
+from workspace_index import WorkspaceIndex
 
 
 class dependency_report_generator:
@@ -13,11 +15,16 @@ class dependency_report_generator:
     _workspace = '.'
     _index = None
     _distribution = None
+    _repos = None
+    _edges = None
 
-    def __init__(self, workspace='.', distro='hydro'):
+    def __init__(self, workspace='.', distro='hydro', session=None,
+                 index_file=None):
+        session = session if session else AnalysisSession()
         self._workspace = workspace
-        self._index = get_index(get_index_url())
-        self._distribution = get_distribution_file(self._index, distro)
+        self._workspace_index = WorkspaceIndex(workspace, index_file)
+        self._index = session.get_index()
+        self._distribution = session.get_distribution_file(distro)
         self._get_packages()
 
     def _get_release_status(self, repo_name):
@@ -30,18 +37,9 @@ class dependency_report_generator:
         return None
 
     def _get_packages(self):
-        to = topological_order.topological_order(self._workspace)
-
+        # only package.xml files changed since the last run are parsed
         result = {}
-        for pname, pkg in to:
-            pkg_info = {}
-            pkg_info['path'] = os.path.dirname(pkg.filename)
-            pkg_info['depends'] = list(set([str(d.name) for d in pkg.build_depends]
-                                       + [str(d.name) for d in pkg.exec_depends]))
-            pkg_info['description'] = (pkg.description)
-            pkg_info['licenses'] = pkg.licenses
-            pkg_info['authors'] = [(a.name) for a in pkg.authors]
-            pkg_info['maintainers'] = [(m.name) for m in pkg.maintainers]
+        for pname, pkg_info in self._workspace_index.packages().items():
             #prefix, pkg_info['package'] = os.path.split(pkg_info['path'])
             prefix, pkg_info['package'] = os.path.split(pkg_info['path'])
             prefix, pkg_info['repo'] = os.path.split(prefix)
@@ -49,18 +47,39 @@ class dependency_report_generator:
                 pkg_info['repo'] = pkg_info['package']
             if pkg_info['repo']:
                 pkg_info['release_status'] = self._get_release_status(pkg_info['repo'])
-            result[pkg.name] = pkg_info
+            result[pname] = pkg_info
         self._pkgs = result
+        self._repos = None
+        self._edges = None
 
     def _get_repos(self):
-        repos = {}
-        for pname, pkg in self._pkgs.items():
-            repo = pkg['repo']
-            if repo not in repos:
-                repos[repo] = []
-            repos[repo].append(pname)
-        return repos
-
+        # repo -> package names, computed once and shared by all generators
+        if self._repos is None:
+            repos = {}
+            for pname, pkg in self._pkgs.items():
+                repo = pkg['repo']
+                if repo not in repos:
+                    repos[repo] = []
+                repos[repo].append(pname)
+            self._repos = repos
+        return self._repos
+
+    def _get_edges(self):
+        # (package, dependency, repo of package, repo of dependency) for
+        # every dependency within the workspace, shared by the graph
+        # generators
+        if self._edges is None:
+            pkg_repo = dict([(pname, pkg['repo'])
+                             for pname, pkg in self._pkgs.items()])
+            self._edges = [
+                (pname, dpkg, pkg_repo[pname], pkg_repo[dpkg])
+                for pname, pkg in self._pkgs.items()
+                for dpkg in pkg['depends']
+                if dpkg in pkg_repo
+            ]
+        return self._edges
+
+    @profiler.timed('rosdepend.repo_graph')
     def generate_repo_dep_graph(self):
         dot = pgv.AGraph(directed=True,
                          strict=True,
@@ -87,26 +106,21 @@ class dependency_report_generator:
                 #break # it's enough to read one package of a repo...
             dot.add_node(k, label='<<I>'+k.upper()+'</I><br align="left"/>'+maintainers+'>', color=nc)
 
-        for pname, pkg in self._pkgs.items():
-            for dpkg in pkg['depends']:
-                if dpkg in self._pkgs:
-                    #dot.node(dpkg)
-                    #nodes.append(dpkg)
-                    repo1 = pkg['repo']
-                    repo2 = self._pkgs[dpkg]['repo']
-                    rs = self._pkgs[dpkg]['release_status']
-                    if not repo1 == repo2:
-                        if rs is None:
-                            ec = 'red'
-                        else:
-                            if rs == 'release':
-                                ec = 'green'
-                            else:
-                                ec = 'yellow'
-                        dot.add_edge(repo1, repo2, weight=10, constraint=True, color=ec)
+        for pname, dpkg, repo1, repo2 in self._get_edges():
+            if not repo1 == repo2:
+                rs = self._pkgs[dpkg]['release_status']
+                if rs is None:
+                    ec = 'red'
+                else:
+                    if rs == 'release':
+                        ec = 'green'
+                    else:
+                        ec = 'yellow'
+                dot.add_edge(repo1, repo2, weight=10, constraint=True, color=ec)
         return dot
 
 
+    @profiler.timed('rosdepend.pkg_graph')
     def generate_pkg_dep_graph(self, within_repo=True, between_repos=None):
         dot = pgv.AGraph(directed=True,
                          strict=True,
@@ -115,16 +129,12 @@ class dependency_report_generator:
                          rankdir='LR',
                          concentrate=True,
                          overlap='scale')
-        nodes = []
         for pname, pkg in self._pkgs.items():
-            if pname not in nodes:
-                repo = pkg['repo']
-                nodes.append(pname)
-                dot.add_node(pname, group=repo, label=pname + ' ['
-                                                            + pkg['maintainers'][0]
-                                                            + ', lic='
-                                                            + pkg['licenses'][0]
-                                                            + ']')
+            dot.add_node(pname, group=pkg['repo'], label=pname + ' ['
+                                                        + pkg['maintainers'][0]
+                                                        + ', lic='
+                                                        + pkg['licenses'][0]
+                                                        + ']')
 
         sub_graphs = self._get_repos()
 
@@ -135,40 +145,45 @@ class dependency_report_generator:
                              style='filled',
                              fillcolor='lightgrey',
                              concentrate=True)
-        for pname, pkg in self._pkgs.items():
-            for dpkg in pkg['depends']:
-                if dpkg in nodes:
-                    #dot.node(dpkg)
-                    #nodes.append(dpkg)
-                    dp = self._pkgs[dpkg]
-                    if within_repo and pkg['repo'] == dp['repo']:
-                        dot.add_edge(pname, dpkg, constraint=True)
-                    if not between_repos is None and not pkg['repo'] == dp['repo']:
-                        if pkg['repo'] in between_repos or dp['repo'] in between_repos:
-                            dot.add_edge(pname, dpkg, constraint=True)
+        if between_repos is not None:
+            between_repos = set(between_repos)
+        for pname, dpkg, repo1, repo2 in self._get_edges():
+            if repo1 == repo2:
+                if within_repo:
+                    dot.add_edge(pname, dpkg, constraint=True)
+            elif between_repos is not None:
+                if repo1 in between_repos or repo2 in between_repos:
+                    dot.add_edge(pname, dpkg, constraint=True)
         return dot
 
 
-    def generate_markdown(self):
+    def iter_markdown(self):
         repos = self._get_repos()
-        outstr = u''
         tablehead = '| package | maintainer | authors | licence | depends on |\n'
         tableline = '| ------- | ---------- | ------- | ------- | ---------- |\n'
 
         for repo, pkgs in repos.iteritems():
-            outstr += '\n# {0}\n\n'.format(repo)
-            outstr += tablehead + tableline
+            yield '\n# {0}\n\n'.format(repo)
+            yield tablehead + tableline
             for p in pkgs:
                 pkg = self._pkgs[p]
                 
-                outstr += u'| {0} | {1} | {2} | {3} | {4} |\n'.format(
+                yield u'| {0} | {1} | {2} | {3} | {4} |\n'.format(
                     p,
                     u', '.join(pkg['maintainers']),
                     u', '.join(pkg['authors']),
                     ', '.join(pkg['licenses']),
                     ', '.join(pkg['depends'])
                 )
-        return outstr
+
+    @profiler.timed('rosdepend.markdown')
+    def write_markdown(self, out):
+        for chunk in self.iter_markdown():
+            out.write(chunk)
+
+    @profiler.timed('rosdepend.markdown')
+    def generate_markdown(self):
+        return u''.join(self.iter_markdown())
 
 
 
@@ -184,21 +199,25 @@ def main():
     parser.add_argument('--output', help='name of the generated PDF, default is output.pdf', default='output.pdf')
     parser.add_argument('--distro', help='name of ROS distro, default: hydro', default='hydro')
     parser.add_argument('--inter-repos', nargs='+', help='show also inter-repository dependencies for these repositories in pkg mode')
+    parser.add_argument('--index', help='package.xml index of the workspace, kept between runs, default: <workspace>/.rosdepend_index.json')
+    add_profile_argument(parser)
     args = parser.parse_args()
+    report_at_exit(args.profile_report)
 
-    drg = dependency_report_generator(args.workspace, args.distro)
+    drg = dependency_report_generator(args.workspace, args.distro,
+                                      index_file=args.index)
+    basename, ext = os.path.splitext(args.output)
+    formats = [ext[1:] or 'pdf']
     if args.mode == 'pkg':
         dot = drg.generate_pkg_dep_graph(between_repos=args.inter_repos)
-        dot.layout(prog='dot')
-        dot.draw(args.output)
+        render(dot, basename, formats)
     if args.mode == 'repo':
         dot = drg.generate_repo_dep_graph()
-        dot.layout(prog='dot')
-        dot.draw(args.output)
+        render(dot, basename, formats)
 
     if args.mode == 'markdown':
-        md = drg.generate_markdown()
-        print md
+        drg.write_markdown(sys.stdout)
+        print
 
 
 
@@ -7,27 +7,44 @@ import sys
 reload(sys)
 from sys import setdefaultencoding
 from shutil import rmtree
-from copy import deepcopy
-from yaml import load, dump
+import yaml
 
-from rosinstall_generator.distro import get_distro, get_package_names
-from rosinstall_generator.distro import get_recursive_dependencies, get_release_tag
+from rosinstall_generator.distro import get_package_names
+from rosinstall_generator.distro import get_release_tag
 
 from collections import defaultdict
 import pygraphviz as pgv
 
-from rosdistro import get_distribution_files, get_index, get_index_url
-from tempfile import mkdtemp
+from analysis_session import AnalysisSession
+from graph_render import render
+from profiling import profiler, add_profile_argument, report_at_exit
+from workspace_index import IGNORE_MARKERS
+
+from tempfile import mkdtemp, mkstemp
 from logging import info, basicConfig, exception, warning, INFO
 
 import xml.etree.ElementTree as ET
-from subprocess import check_call
-from os.path import join
+try:
+    import xml.etree.cElementTree as cET
+except ImportError:
+    cET = ET
+from subprocess import check_call, check_output, Popen, PIPE, CalledProcessError
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+from multiprocessing.pool import ThreadPool
+from os.path import join, dirname, basename, isdir, abspath
+from os import makedirs, rename, fdopen, remove
+from hashlib import sha1
+import json
 from copy import copy
 from catkin_pkg import topological_order
+from catkin_pkg.package import parse_package_string
 
 setdefaultencoding('utf8')
 
+# the only files needed from a source repository to find its packages
+SPARSE_CHECKOUT_PATTERNS = ['package.xml'] + IGNORE_MARKERS
+
 def dictify(r, root=True):
     if root:
         return {r.tag: dictify(r, False)}
@@ -41,45 +58,479 @@ def dictify(r, root=True):
     return d
 
 
+# the package.xml elements the analyser reads
+PACKAGE_XML_FIELDS = ['author', 'maintainer', 'description', 'license', 'url']
+
+
+class _PackageXmlFields(object):
+    # parser target collecting the leading text of the PACKAGE_XML_FIELDS
+    # elements directly below <package>; no tree is built and everything
+    # else is skipped as it streams by
+
+    def __init__(self):
+        self._depth = 0
+        self._text = None
+        self._leading = False
+        self.fields = defaultdict(list)
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        if self._depth == 2:
+            self._text = [] if tag in PACKAGE_XML_FIELDS else None
+            self._leading = True
+        elif self._depth == 3:
+            # only the text before the first child is the element's text
+            self._leading = False
+
+    def data(self, data):
+        if self._depth == 2 and self._text is not None and self._leading:
+            self._text.append(data)
+
+    def end(self, tag):
+        if self._depth == 2 and self._text is not None:
+            self.fields[tag].append(''.join(self._text))
+            self._text = None
+        self._depth -= 1
+
+    def close(self):
+        return self.fields
+
+
+def extract_package_xml(xml):
+    # one pass over a package.xml, returning the fields the analyser keeps
+    # for a package. Gives the same result as extracting them from
+    # dictify(ET.fromstring(xml)), except that empty elements give '' where
+    # the dictified document had no text to read.
+    parser = cET.XMLParser(target=_PackageXmlFields())
+    parser.feed(xml)
+    fields = parser.close()
+    return {
+        'authors': fields['author'] if 'author' in fields else '',
+        'maintainers': (fields['maintainer']
+                        if 'maintainer' in fields else ''),
+        'description': (' '.join(fields['description'])
+                        if 'description' in fields else ''),
+        'license': (' '.join(fields['license'])
+                    if 'license' in fields else ''),
+        'url': (fields['url'][0] or None) if 'url' in fields else None
+    }
+
+
+# strings shared by many records (dependency and repository names,
+# maintainers, licenses, ...) are only held once
+_strings = {}
+_frozensets = {}
+EMPTY = frozenset()
+
+
+def intern_string(s):
+    if isinstance(s, basestring):
+        return _strings.setdefault(s, s)
+    return s
+
+
+def shared_frozenset(items):
+    fs = frozenset([intern_string(i) for i in items])
+    return _frozensets.setdefault(fs, fs)
+
+
+class Record(object):
+    # base of the slotted records below, which keep the dict interface the
+    # analyser and the snapshot code use
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__slots__]
+
+    def update(self, fields):
+        for k, v in dict(fields).items():
+            self[k] = v
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**dict([(k, v) for k, v in d.items() if k in cls.__slots__]))
+
+
+class PackageRecord(Record):
+
+    __slots__ = ('name', 'authors', 'maintainers', 'url', 'description',
+                 'license', 'status', 'deps', 'repository')
+
+    def __init__(self, name=None, authors=(), maintainers=(), url='',
+                 description='', license='unknown', status='unknown',
+                 deps=EMPTY, repository=None):
+        self.name = intern_string(name)
+        self.authors = tuple([intern_string(a) for a in authors])
+        self.maintainers = tuple([intern_string(m) for m in maintainers])
+        self.url = url
+        self.description = description
+        self.license = intern_string(license)
+        self.status = intern_string(status)
+        self.deps = shared_frozenset(deps)
+        self.repository = intern_string(repository)
+
+
+class RepositoryRecord(Record):
+
+    __slots__ = ('packages', 'type', 'url', 'release_url', 'version',
+                 'release_version', 'requires_repositories',
+                 'required_by_repositories', 'external_dependencies',
+                 'internal_dependencies', 'status', 'jenkins_job')
+
+    def __init__(self, packages=None, type=None, url=None, release_url=None,
+                 version=None, release_version=None,
+                 requires_repositories=EMPTY,
+                 required_by_repositories=EMPTY,
+                 external_dependencies=EMPTY,
+                 internal_dependencies=EMPTY,
+                 status='unknown', jenkins_job=None):
+        self.packages = dict([
+            (intern_string(p), pkg if isinstance(pkg, PackageRecord)
+             else PackageRecord.from_dict(pkg))
+            for p, pkg in (packages or {}).items()])
+        self.type = intern_string(type)
+        self.url = url
+        self.release_url = release_url
+        self.version = intern_string(version)
+        self.release_version = release_version
+        self.requires_repositories = shared_frozenset(requires_repositories)
+        self.required_by_repositories = shared_frozenset(
+            required_by_repositories)
+        self.external_dependencies = shared_frozenset(external_dependencies)
+        self.internal_dependencies = shared_frozenset(internal_dependencies)
+        self.status = intern_string(status)
+        self.jenkins_job = jenkins_job
+
+
+class PackageXmlCache:
+    # on-disk cache of release package.xml documents, keyed by distro,
+    # package and release version, so that unchanged releases are not
+    # fetched again. Installed as manifest provider of the distro with
+    # install(), so that every reader of the distro's package.xml files
+    # (dependency walker included) goes through it.
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+
+    def _path(self, distro, package, version):
+        key = sha1(json.dumps([distro, package, version])).hexdigest()
+        return join(self._cache_dir, key[:2], key + '.json')
+
+    def get(self, distro, package, version):
+        try:
+            with open(self._path(distro, package, version), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def put(self, distro, package, version, xml, fields):
+        path = self._path(distro, package, version)
+        try:
+            makedirs(dirname(path))
+        except OSError:
+            if not isdir(dirname(path)):
+                raise
+        # write to a temp file first, so concurrent readers never see a
+        # partial entry
+        fd, tmp_path = mkstemp(dir=dirname(path))
+        with fdopen(fd, 'w') as f:
+            json.dump({
+                'distro': distro,
+                'package': package,
+                'version': version,
+                'xml': xml,
+                'fields': fields
+            }, f)
+        rename(tmp_path, path)
+
+    def install(self, distro, distro_name):
+        # puts the cache in front of the manifest providers of a rosdistro
+        # Distribution; documents are only fetched by the original
+        # providers if they are not cached yet, and are cached then
+        providers = distro._manifest_providers
+
+        def provider(dist_name, repo, pkg_name):
+            cached = self.get(distro_name, pkg_name, repo.version)
+            profiler.cache('package_xml_cache', cached is not None)
+            if cached:
+                return cached['xml']
+            for mp in providers:
+                xml = mp(dist_name, repo, pkg_name)
+                if xml is not None:
+                    self.put(distro_name, pkg_name, repo.version, xml,
+                             extract_package_xml(xml))
+                    return xml
+            return None
+        distro._manifest_providers = [provider]
+
+
+def find_package_xmls(paths):
+    # mimics the catkin package crawler on a list of repository paths:
+    # skips ignored directories and does not descend into packages
+    ignored = set([
+        dirname(p) for p in paths if basename(p) in IGNORE_MARKERS])
+    found = set([])
+    res = []
+    for d in sorted(
+            [dirname(p) for p in paths if basename(p) == 'package.xml'],
+            key=lambda d: d.count('/')):
+        parts = d.split('/') if d else []
+        ancestors = [''] + ['/'.join(parts[:i + 1]) for i in range(len(parts))]
+        if ignored.intersection(ancestors):
+            continue
+        if found.intersection(ancestors[:-1]):
+            continue
+        found.add(d)
+        res.append(join(d, 'package.xml'))
+    return sorted(res)
+
+
+class MirrorPool:
+    # bare, blob-less mirrors of source repositories that are kept across
+    # runs; only new commits of the tracked branch are fetched, and the
+    # package.xml files are read from the object store without a working
+    # tree. Each mirror is guarded by a lock file, so several analyser
+    # processes can share the pool.
+
+    def __init__(self, mirror_dir):
+        self._mirror_dir = mirror_dir
+        if not isdir(mirror_dir):
+            makedirs(mirror_dir)
+
+    def _path(self, url):
+        return join(self._mirror_dir, sha1(url).hexdigest() + '.git')
+
+    @contextmanager
+    def _locked(self, path):
+        with open(path + '.lock', 'w') as lock:
+            flock(lock, LOCK_EX)
+            try:
+                yield
+            finally:
+                flock(lock, LOCK_UN)
+
+    @profiler.timed('mirror.update')
+    def _update(self, url, branch, path):
+        ref = 'refs/heads/%s' % branch
+        if not isdir(path):
+            tmp_path = path + '.tmp'
+            if isdir(tmp_path):
+                rmtree(tmp_path)
+            check_call(["git", "clone", '--bare', '--filter=blob:none',
+                '--single-branch', '-b', branch, url, tmp_path])
+            rename(tmp_path, path)
+        else:
+            check_call(["git", "fetch", '--quiet', 'origin',
+                '+%s:%s' % (ref, ref)], cwd=path)
+        return ref
+
+    @profiler.timed('mirror.package_xmls')
+    def package_xmls(self, url, branch):
+        # returns a dict of path -> content of all package.xml files on the
+        # given branch
+        path = self._path(url)
+        with self._locked(path):
+            ref = self._update(url, branch, path)
+            files = check_output(
+                ["git", "ls-tree", "-r", "-z", "--name-only", ref],
+                cwd=path).split('\0')
+            pxmls = find_package_xmls([f for f in files if f])
+            if not pxmls:
+                return {}
+            # a single cat-file process reads all blobs, fetching the
+            # missing ones from the promisor remote on demand
+            p = Popen(["git", "cat-file", "--batch"],
+                      stdin=PIPE, stdout=PIPE, cwd=path)
+            out, _ = p.communicate(
+                ''.join(['%s:%s\n' % (ref, f) for f in pxmls]))
+            if p.returncode:
+                raise CalledProcessError(p.returncode, 'git cat-file --batch')
+        res = {}
+        pos = 0
+        for f in pxmls:
+            eol = out.index('\n', pos)
+            header = out[pos:eol].split()
+            pos = eol + 1
+            if header[-1] == 'missing':
+                continue
+            size = int(header[2])
+            res[f] = out[pos:pos + size]
+            pos += size + 1
+        profiler.add_bytes('mirror.package_xmls', len(out))
+        return res
+
+    def packages(self, url, branch):
+        return [
+            parse_package_string(xml, filename=f)
+            for f, xml in sorted(self.package_xmls(url, branch).items())
+        ]
+
+
+SNAPSHOT_FORMAT = 'rosdistro_analyser snapshot'
+SNAPSHOT_VERSION = 1
+# fields holding sets, which are stored as sorted lists
+REPOSITORY_SETS = [
+    'requires_repositories', 'required_by_repositories',
+    'external_dependencies', 'internal_dependencies'
+]
+PACKAGE_SETS = ['deps']
+
+
+def _encode_url(url):
+    # old YAML snapshots hold catkin_pkg Url objects for the url of
+    # unreleased packages
+    if url is None or isinstance(url, basestring):
+        return url
+    return url.url
+
+
+def _encode_repository(repo):
+    doc = dict(repo)
+    for k in REPOSITORY_SETS:
+        doc[k] = sorted(doc[k])
+    doc['packages'] = {}
+    for p, pkg in repo['packages'].items():
+        doc['packages'][p] = dict(pkg)
+        doc['packages'][p]['url'] = _encode_url(pkg['url'])
+        for k in PACKAGE_SETS:
+            doc['packages'][p][k] = sorted(pkg[k])
+    return doc
+
+
+def write_snapshot(filename, repositories, distro=None):
+    # A header line, then one line per repository: its name, a tab, and the
+    # repository with its packages as JSON. Packages are only stored within
+    # their repository; the package index is rebuilt on load. Written to a
+    # temp file first, so a failed write never leaves a partial snapshot.
+    fd, tmp_path = mkstemp(dir=dirname(abspath(filename)))
+    try:
+        with fdopen(fd, 'w') as f:
+            f.write(json.dumps({
+                'format': SNAPSHOT_FORMAT,
+                'version': SNAPSHOT_VERSION,
+                'distro': distro
+            }) + '\n')
+            for r in sorted(repositories):
+                f.write('%s\t%s\n' % (r, json.dumps(
+                    _encode_repository(repositories[r]),
+                    sort_keys=True, separators=(',', ':'))))
+    except:
+        remove(tmp_path)
+        raise
+    rename(tmp_path, filename)
+
+
+class SnapshotReader:
+    # Reader of a snapshot written by write_snapshot. Repositories are read
+    # and decoded one line at a time, so only the repository being handed
+    # out is held in its decoded JSON form. All strings are interned, so the
+    # names of dependencies, maintainers, licenses etc. are only held once.
+
+    def __init__(self, filename):
+        self._filename = filename
+        with open(filename, 'r') as f:
+            self.header = json.loads(f.readline())
+        if (self.header.get('format') != SNAPSHOT_FORMAT
+                or self.header.get('version') != SNAPSHOT_VERSION):
+            raise ValueError('%s is not a version %d snapshot' % (
+                filename, SNAPSHOT_VERSION))
+
+    def _intern(self, o):
+        if isinstance(o, basestring):
+            return intern_string(o)
+        if isinstance(o, list):
+            return [self._intern(i) for i in o]
+        if isinstance(o, dict):
+            return dict([
+                (self._intern(k), self._intern(v)) for k, v in o.items()])
+        return o
+
+    def _decode(self, line):
+        repo = self._intern(json.loads(line))
+        for k in REPOSITORY_SETS:
+            repo[k] = set(repo[k])
+        for pkg in repo['packages'].values():
+            for k in PACKAGE_SETS:
+                pkg[k] = set(pkg[k])
+        return repo
+
+    def __iter__(self):
+        # (name, repository) pairs, in the order they were written
+        with open(self._filename, 'r') as f:
+            f.readline()
+            for l in f:
+                if not l.strip():
+                    continue
+                name, line = l.rstrip('\n').split('\t', 1)
+                yield name, self._decode(line)
+
+
+def load_yaml_snapshot(filename):
+    # snapshots of older versions were YAML dumps, which need the full
+    # (unsafe) loader for their python tags; only ever used to read or
+    # convert those
+    loader = getattr(yaml, 'CLoader', yaml.Loader)
+    with open(filename, 'r') as f:
+        doc = yaml.load(f, Loader=loader)
+    return sorted(doc['repositories'].items())
+
+
+def load_snapshot(filename):
+    # returns the (name, repository) pairs of a snapshot of either format;
+    # those of a JSON snapshot are decoded as they are iterated over
+    with open(filename, 'r') as f:
+        first = f.readline()
+    try:
+        is_json = json.loads(first).get('format') == SNAPSHOT_FORMAT
+    except (ValueError, AttributeError):
+        is_json = False
+    if is_json:
+        return SnapshotReader(filename)
+    warning('%s is an old YAML snapshot, consider converting it' % filename)
+    return load_yaml_snapshot(filename)
+
+
+def convert_yaml_snapshot(yaml_filename, filename):
+    repositories = dict(load_yaml_snapshot(yaml_filename))
+    write_snapshot(filename, repositories)
+
+
 class CacheAnalyser:
 
     def __init__(self, distro='kinetic', tags=['lcas'],
         analyse_release=True, analyse_source=True,
-        repo_whitelist=None
+        repo_whitelist=None, jobs=1, xml_cache_dir=None,
+        fetch_mode='clone', mirror_dir=None, session=None
     ):
+        # analysers sharing a session share the index and all caches
+        self._session = session if session else AnalysisSession()
         self._distro_name = distro
-        self._distro = get_distro(distro)
-        self._pkgs = {}
-        __repo_template = {
-            'packages': {},
-            'type': None,
-            'url': None,
-            'release_url': None,
-            'version': None,
-            'release_version': None,
-            'requires_repositories': set([]),
-            'required_by_repositories': set([]),
-            'external_dependencies': set([]),
-            'internal_dependencies': set([]),
-            'status': 'unknown',
-            'jenkins_job': None
-        }
-        __pkg_template = {
-            'name': None,
-            'authors': [],
-            'maintainers': [],
-            'url': '',
-            'description': '',
-            'license': 'unknown',
-            'status': 'unknown',
-            'deps': set([]),
-            'repository': None
-        }
-        self._repositories = defaultdict(lambda: deepcopy(__repo_template))
-        self._pkgs = defaultdict(lambda: deepcopy(__pkg_template))
+        self._distro = self._session.get_distro(distro)
+        self._repositories = defaultdict(RepositoryRecord)
+        self._pkgs = defaultdict(PackageRecord)
 
-        self._index = get_index(get_index_url())
-        self._distributions = get_distribution_files(self._index, distro)
+        self._index = self._session.get_index()
+        self._distributions = self._session.get_distribution_files(distro)
 
         self._distribution = None
         for d in self._distributions:
@@ -99,66 +550,229 @@ class CacheAnalyser:
         self._analyse_release = analyse_release
         self._analyse_source = analyse_source
         self._repo_whitelist = repo_whitelist
+        self._jobs = jobs
+        self._fetch_mode = fetch_mode
+        self._mirror_pool = (
+            self._session.shared(
+                ('mirror_pool', mirror_dir), lambda: MirrorPool(mirror_dir))
+            if mirror_dir else None)
+        self._xml_cache = (
+            self._session.shared(
+                ('xml_cache', xml_cache_dir),
+                lambda: PackageXmlCache(xml_cache_dir))
+            if xml_cache_dir else None)
+        if self._xml_cache:
+            # the distro is shared by the session, so this is done once
+            self._session.shared(
+                ('xml_cache_installed', distro, xml_cache_dir),
+                lambda: self._xml_cache.install(self._distro, distro))
+        # (url, branch) -> packages of source repositories already analysed,
+        # e.g. for another distro
+        self._source_packages = self._session.shared(
+            ('source_packages', fetch_mode, mirror_dir), dict)
 
         self._distro_repositories = self._distribution.repositories
         self._released_packages_set = set(self._distribution.release_packages)
+        self._dependency_index = self._session.get_dependency_index(distro)
 
-    def _analyse_repos(self):
+    @profiler.timed('analyser.analyse_repos')
+    def _analyse_repos(self, repo_names=None):
         tmp_dir = mkdtemp()
         try:
-            for r, sg in self._distro_repositories.items():
-                if self._repo_whitelist:
-                    if r not in self._repo_whitelist:
-                        continue
+            repos = [
+                (r, sg) for r, sg in self._distro_repositories.items()
+                if (not self._repo_whitelist or r in self._repo_whitelist)
+                and (repo_names is None or r in repo_names)
+            ]
+            if self._analyse_release:
+                self._resolve_dependencies([
+                    p for r, sg in repos if sg.release_repository
+                    for p in sg.release_repository.package_names])
+            if self._jobs > 1:
+                pool = ThreadPool(self._jobs)
                 try:
-                    info('analysing repository %s' % r)
-                    if sg.release_repository and self._analyse_release:  # released
-                        self._repositories[r]['packages'] = self._analyse_released_repo(sg)
-                        self._repositories[r]['status'] = 'released'
-                        self._repositories[r]['release_url'] = sg.release_repository.url
-                        self._repositories[r]['release_version'] = sg.release_repository.version
-                        info('-> repository %s is RELEASED as version %s with packages "%s"' % (
-                            r, sg.release_repository.version, ', '.join(list(self._repositories[r]['packages']))))
-                    elif sg.source_repository and self._analyse_source:  # not released but source available
-                        if sg.source_repository.type == 'git':
-                            self._repositories[r]['packages'] = self._analyse_non_released_repo(sg, tmp_dir)
-                            self._repositories[r]['status'] = 'source'
-                            info('-> repository %s is NON-released with packages "%s"' % (
-                                r, ', '.join(list(self._repositories[r]['packages']))))
-                        else:
-                            warning('skipping source repository %s as it is not git' % r)
-                    if sg.source_repository:
-                        self._repositories[r]['type'] = sg.source_repository.type
-                        self._repositories[r]['url'] = sg.source_repository.url
-                        self._repositories[r]['version'] = sg.source_repository.version
-                        if sg.source_repository.test_commits:
-                            self._repositories[r]['jenkins_job'] = self.__jenkins_url_template_dev % r
-                        
-                    self._pkgs.update(self._repositories[r]['packages'])
-                except Exception  as e:
-                    exception("skipping %s as exception occured" % r)
+                    results = pool.map(
+                        lambda repo: self._analyse_repo(repo[0], repo[1], tmp_dir),
+                        repos)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [self._analyse_repo(r, sg, tmp_dir) for r, sg in repos]
 
+            # merge in distribution file order, so the result does not depend
+            # on the order in which the workers finished
+            for (r, sg), (fields, ok) in zip(repos, results):
+                if fields:
+                    self._repositories[r].update(fields)
+                if ok:
+                    self._pkgs.update(self._repositories[r]['packages'])
         finally:
             rmtree(tmp_dir)
         self._analyse_deps()
 
+    @profiler.timed('analyser.resolve_dependencies')
+    def _resolve_dependencies(self, package_names):
+        # resolves the dependencies of all given release packages in one go,
+        # before any worker looks them up
+        self._dependency_index.resolve(package_names)
+
+    def _changed_repos(self):
+        # compares the loaded snapshot with the current distribution file and
+        # returns the repositories that are new or have moved, and the ones
+        # that are gone from the distribution file
+        changed = set([])
+        for r, sg in self._distro_repositories.items():
+            if self._repo_whitelist and r not in self._repo_whitelist:
+                continue
+            # failed analyses are tried again
+            if (r not in self._repositories
+                    or self._repositories[r]['status'] == 'failed'):
+                changed.add(r)
+                continue
+            repo = self._repositories[r]
+            current = (
+                sg.release_repository.url if sg.release_repository else None,
+                sg.release_repository.version if sg.release_repository else None,
+                sg.source_repository.url if sg.source_repository else None,
+                sg.source_repository.version if sg.source_repository else None
+            )
+            previous = (
+                repo['release_url'], repo['release_version'],
+                repo['url'], repo['version']
+            )
+            if current != previous:
+                changed.add(r)
+        removed = set([
+            r for r in self._repositories
+            if r not in self._distro_repositories
+            or (self._repo_whitelist and r not in self._repo_whitelist)
+        ])
+        return changed, removed
+
+    def _analyse_changed_repos(self):
+        # incremental analysis on top of a loaded snapshot: only repositories
+        # that changed, and those that (transitively) require them, are
+        # analysed again
+        changed, removed = self._changed_repos()
+        affected = set([])
+        todo = list(changed | removed)
+        while todo:
+            r = todo.pop()
+            if r in affected:
+                continue
+            affected.add(r)
+            if r in self._repositories:
+                todo.extend(self._repositories[r]['required_by_repositories'])
+        info('%d repositories changed, %d removed, re-analysing %d' % (
+            len(changed), len(removed), len(affected - removed)))
+
+        for p in [p for p in self._pkgs
+                  if self._pkgs[p]['repository'] in affected]:
+            del self._pkgs[p]
+        for r in affected:
+            if r in self._repositories:
+                del self._repositories[r]
+        # repository dependencies are derived from all packages, so they are
+        # recomputed from scratch by _analyse_deps
+        for repo in self._repositories.values():
+            repo['requires_repositories'] = EMPTY
+            repo['required_by_repositories'] = EMPTY
+            repo['external_dependencies'] = EMPTY
+            repo['internal_dependencies'] = EMPTY
+
+        self._analyse_repos(affected - removed)
+
+    @profiler.timed('analyser.repository')
+    def _analyse_repo(self, r, sg, tmp_dir):
+        # analyses one repository without touching shared state and returns
+        # the fields to merge into its entry and whether it succeeded. Failed
+        # repositories get the status 'failed', so that incremental runs
+        # analyse them again.
+        fields = {}
+        try:
+            info('analysing repository %s' % r)
+            if sg.source_repository:
+                fields['type'] = sg.source_repository.type
+                fields['url'] = sg.source_repository.url
+                fields['version'] = sg.source_repository.version
+                if sg.source_repository.test_commits:
+                    fields['jenkins_job'] = self.__jenkins_url_template_dev % r
+            if sg.release_repository and self._analyse_release:  # released
+                fields['packages'] = self._analyse_released_repo(sg)
+                fields['status'] = 'released'
+                fields['release_url'] = sg.release_repository.url
+                fields['release_version'] = sg.release_repository.version
+                info('-> repository %s is RELEASED as version %s with packages "%s"' % (
+                    r, sg.release_repository.version, ', '.join(list(fields['packages']))))
+            elif sg.source_repository and self._analyse_source:  # not released but source available
+                if sg.source_repository.type == 'git':
+                    packages = self._analyse_non_released_repo(sg, tmp_dir)
+                    if packages is None:
+                        fields['packages'] = {}
+                        fields['status'] = 'failed'
+                        warning('-> repository %s could not be analysed' % r)
+                        return fields, False
+                    fields['packages'] = packages
+                    fields['status'] = 'source'
+                    info('-> repository %s is NON-released with packages "%s"' % (
+                        r, ', '.join(list(fields['packages']))))
+                else:
+                    warning('skipping source repository %s as it is not git' % r)
+            return fields, True
+        except Exception  as e:
+            exception("skipping %s as exception occured" % r)
+            fields['packages'] = {}
+            fields['status'] = 'failed'
+            return fields, False
+
+    @profiler.timed('analyser.dependency_pass')
     def _analyse_deps(self):
-        for p in self._pkgs:
-            pkg = self._pkgs[p]
-            repo = pkg['repository']
+        # package -> repository index, built once for the whole pass
+        pkg_repos = dict(
+            [(p, pkg['repository']) for p, pkg in self._pkgs.items()])
+        # the records hold frozensets, so collect everything first
+        requires = defaultdict(set)
+        required_by = defaultdict(set)
+        internal = defaultdict(set)
+        external = defaultdict(set)
+        for p, pkg in self._pkgs.items():
+            repo = pkg_repos[p]
             info('analyse dependencies for package %s' % p)
-            internal_deps = pkg['deps'].intersection(set(self._pkgs))
-            external_deps = pkg['deps'].difference(set(self._pkgs))
-            for d in internal_deps:
-                dep_repo = self._pkgs[d]['repository']
-                if repo != dep_repo:  # ignore self-dep
-                    self._repositories[dep_repo]['required_by_repositories'].add(repo)
-                    self._repositories[repo]['requires_repositories'].add(dep_repo)
-                    self._repositories[repo]['internal_dependencies'].update(internal_deps)
-
-            self._repositories[repo]['external_dependencies'].update(external_deps)
-
-    def _extract_from_package_xml(self, px):
+            internal_deps = set([])
+            external_deps = set([])
+            for d in pkg['deps']:
+                if d in pkg_repos:
+                    internal_deps.add(d)
+                else:
+                    external_deps.add(d)
+            dep_repos = set([pkg_repos[d] for d in internal_deps])
+            dep_repos.discard(repo)  # ignore self-dep
+            if dep_repos:
+                requires[repo].update(dep_repos)
+                internal[repo].update(internal_deps)
+                for dep_repo in dep_repos:
+                    required_by[dep_repo].add(repo)
+
+            external[repo].update(external_deps)
+
+        for field, deps in [
+                ('requires_repositories', requires),
+                ('required_by_repositories', required_by),
+                ('internal_dependencies', internal),
+                ('external_dependencies', external)]:
+            for r, d in deps.items():
+                repo = self._repositories[r]
+                repo[field] = shared_frozenset(repo[field].union(d))
+
+    def repository_adjacency(self):
+        # repository -> set of repositories it requires
+        return dict([
+            (r, repo['requires_repositories'])
+            for r, repo in self._repositories.items()])
+
+    @staticmethod
+    def _extract_from_package_xml(px):
         return {
             'authors': ([a['_text']
                             for a in px['author']]
@@ -185,37 +799,58 @@ class CacheAnalyser:
         _pkg={}
 
         for p in sg.release_repository.package_names:
-            deps = get_recursive_dependencies(self._distro, [p], limit_depth=1)
+            deps = self._dependency_index.get(p)
             e = {
                 'name': p,
                 'status': 'released',
                 'deps': deps,  
                 'repository': self._distribution.release_packages[p].repository_name
             }
-            px = self.parse_package_xml(p)['package']
-            e.update(self._extract_from_package_xml(px))
+            e.update(self.parse_package_xml(
+                p, sg.release_repository.version))
 
-            _pkg[p] = e 
+            _pkg[p] = PackageRecord(**e)
         return _pkg
 
-    def _analyse_non_released_repo(self, sg, tmp_dir):
-        _pkgs={}
-
+    def __get_source_packages(self, sg, tmp_dir):
+        # returns the packages of a source repository, or None on failure
+        if self._mirror_pool:
+            try:
+                return self._mirror_pool.packages(
+                    sg.source_repository.url,
+                    sg.source_repository.version)
+            except Exception:
+                exception('exception when trying to analyse mirror of repository %s, returning [].' % sg.name)
+                return None
         try:
             self.__checkout(
                 sg.source_repository.url,
                 sg.source_repository.version,
                 sg.name, tmp_dir)
         except Exception:
-            exception('exception when trying to checkout repository %s. Carrying on regardless.' % sg.name)
+            exception('exception when trying to checkout repository %s.' % sg.name)
+            return None
         try:
-            pkgs = [
+            return [
                 p[1] for p in topological_order.topological_order(
                     join(tmp_dir, sg.name))
                     ]
         except Exception:
             exception('exception when trying to analyse repository %s, returning [].' % sg.name)
-            return _pkgs
+            return None
+
+    def _analyse_non_released_repo(self, sg, tmp_dir):
+        # returns None if the repository could not be fetched or parsed
+        _pkgs={}
+
+        key = (sg.source_repository.url, sg.source_repository.version)
+        pkgs = self._source_packages.get(key)
+        profiler.cache('source_packages', pkgs is not None)
+        if pkgs is None:
+            pkgs = self.__get_source_packages(sg, tmp_dir)
+            if pkgs is None:
+                return None
+            self._source_packages[key] = pkgs
 
         for pkg in pkgs:
             #print pkg
@@ -225,40 +860,65 @@ class CacheAnalyser:
                 'deps': set([str(d.name) for d in pkg.build_depends]
                             + [str(d.name) for d in pkg.exec_depends]),
                 'repository': sg.name,
-                'url': pkg.urls[0] if pkg.urls else None,
+                'url': pkg.urls[0].url if pkg.urls else None,
                 'description': pkg.description,
                 'authors': [str(a.name) for a in pkg.authors],
                 'maintainers': [str(a.name) for a in pkg.maintainers],
                 'license': ', '.join(pkg.licenses)
             }
-            _pkgs[pkg.name] = e 
+            _pkgs[pkg.name] = PackageRecord(**e)
         
         return _pkgs
 
+    @profiler.timed('analyser.checkout')
     def __checkout(self, url, branch, name, dir):
+        if self._fetch_mode == 'sparse':
+            self.__sparse_checkout(url, branch, name, dir)
+            return
         check_call(["git", "clone", '--depth', '1',
             #'--recurse-submodules',
             '-b', branch, url, name], cwd=dir)
 
-    def parse_package_xml(self, package):
-            xml = self._distro.get_release_package_xml(package)
-            root = ET.fromstring(xml)
-            return dictify(root)
+    def __sparse_checkout(self, url, branch, name, dir):
+        # partial clone without any blobs, then a sparse checkout that only
+        # materialises the files topological_order looks at, so only those
+        # blobs are ever transferred
+        check_call(["git", "clone", '--depth', '1', '--filter=blob:none',
+            '--no-checkout', '-b', branch, url, name], cwd=dir)
+        repo_dir = join(dir, name)
+        check_call(["git", "config", "core.sparseCheckout", "true"],
+            cwd=repo_dir)
+        with open(join(repo_dir, '.git', 'info', 'sparse-checkout'), 'w') as f:
+            f.write('\n'.join(SPARSE_CHECKOUT_PATTERNS) + '\n')
+        check_call(["git", "read-tree", "-mu", "HEAD"], cwd=repo_dir)
+
+    def parse_package_xml(self, package, version=None):
+            if self._xml_cache and version:
+                cached = self._xml_cache.get(
+                    self._distro_name, package, version)
+                # entries written before the fields were cached only have
+                # the document, which the distro reads from the cache below
+                if cached and 'fields' in cached:
+                    return cached['fields']
+            # goes through the package.xml cache, if there is one
+            with profiler.stage('analyser.fetch_package_xml'):
+                xml = self._distro.get_release_package_xml(package)
+            profiler.add_bytes('analyser.fetch_package_xml', len(xml or ''))
+            with profiler.stage('analyser.extract_package_xml'):
+                return extract_package_xml(xml)
 
+    @profiler.timed('analyser.write_snapshot')
     def write(self, filename):
-        with open(filename, 'w') as f:
-            doc = {
-                'repositories': dict(self._repositories),
-                'pkgs': dict(self._pkgs)
-            }
-            f.write(dump(doc))
+        write_snapshot(filename, self._repositories, self._distro_name)
 
+    @profiler.timed('analyser.load_snapshot')
     def load(self, filename):
-        with open(filename, 'r') as f:
-            doc = load(f.read())
-            self._repositories.update(doc['repositories'])
-            self._pkgs.update(doc['pkgs'])
+        for r, repo in load_snapshot(filename):
+            repo = RepositoryRecord.from_dict(repo)
+            self._repositories[r] = repo
+            self._pkgs.update(repo['packages'])
 
+    @profiler.timed('analyser.graph')
     def generate_graph(self):
         dot = pgv.AGraph(label="<<B>Dependency Graph of Repositories</B>>",
                          directed=True,
@@ -363,82 +1023,83 @@ class CacheAnalyser:
         )
         return str
 
-    def generate_md_repo(self, repo_name):
+    def iter_md_repo(self, repo_name):
         repo = self._repositories[repo_name]
-        str = '---\n\n# %s\n' % repo_name
+        yield '---\n\n# %s\n' % repo_name
 
         if repo['release_version'] and repo['release_url']:
-            str += '## Install from released Ubuntu packages\n'
-            str += 'Install using `apt install %s`.\n\n' % (
+            yield '## Install from released Ubuntu packages\n'
+            yield 'Install using `apt install %s`.\n\n' % (
                 ' '.join(
                     ['ros-%s-%s' % (
                         self._distro_name, pname.replace('_','-')
                     ) for pname in repo['packages']])
             )
-            str += '<img src="ubuntu.svg" height="12px"/> released version: **`%s`** (via release repository: %s)\n\n' % (
+            yield '<img src="ubuntu.svg" height="12px"/> released version: **`%s`** (via release repository: %s)\n\n' % (
                 repo['release_version'], repo['release_url']
             )
 
         if repo['type'] == 'git':
             if repo['jenkins_job']:
-                str += '<img src="git.svg" height="12px"/> source code: %s (branch: `%s`) [![buildStatus](%s/badge/icon)](%s)\n\n' % (
+                yield '<img src="git.svg" height="12px"/> source code: %s (branch: `%s`) [![buildStatus](%s/badge/icon)](%s)\n\n' % (
                     repo['url'], repo['version'], repo['jenkins_job'], repo['jenkins_job']
                 )
             else:
-                str += '<img src="git.svg" height="12px"/> source code: %s (branch: `%s`)\n\n' % (
+                yield '<img src="git.svg" height="12px"/> source code: %s (branch: `%s`)\n\n' % (
                     repo['url'], repo['version']
                 )
 
             if repo['status'] == 'source':
-                str += '\n## Install from source\n'
-                str += '\n`rosinstall` definition (including any unreleased dependencies), to be used with [`wstool`](http://wiki.ros.org/wstool):\n'
-                str += '\n```\n%s' % (
+                yield '\n## Install from source\n'
+                yield '\n`rosinstall` definition (including any unreleased dependencies), to be used with [`wstool`](http://wiki.ros.org/wstool):\n'
+                yield '\n```\n%s' % (
                     self.generate_rosinstall(repo_name)
                 )
                 if repo['requires_repositories']:
                     for d in repo['requires_repositories']:
                         if self._repositories[d]['status'] != 'released':
-                            str += '%s' % (
+                            yield '%s' % (
                                 self.generate_rosinstall(d)
                             )
-                str += '```\n'
+                yield '```\n'
 
         if repo['requires_repositories']:
-            str += '\n## Repository dependencies\n'
-            str += 'depends on these other repositories: '
-            str += ', '.join(['[`%s`](#%s)\n' % (d, d) for d in repo['requires_repositories']])
-        str += '\n\n'
+            yield '\n## Repository dependencies\n'
+            yield 'depends on these other repositories: '
+            yield ', '.join(['[`%s`](#%s)\n' % (d, d) for d in repo['requires_repositories']])
+        yield '\n\n'
 
 
-        str += '\n## Included packages\n\n'
+        yield '\n## Included packages\n\n'
         tablehead = '| package | maintainer | authors | licence |\n'
         tableline = '| ------- | ---------- | ------- | ------- |\n'
-        str += tablehead + tableline
+        yield tablehead + tableline
         for p in repo['packages']:
             # str+='## Package **%s**\n*%s*\n' % (
             #     p, repo['packages'][p]['package']['description']
             # )
-            str+=self.generate_md_package(repo['packages'][p])
-        return str
+            yield self.generate_md_package(repo['packages'][p])
 
-    def generate_markdown_repos(self):
+    def generate_md_repo(self, repo_name):
+        return ''.join(self.iter_md_repo(repo_name))
+
+    def iter_markdown_repos(self):
         repos = self._repositories
         # outstr = u''
         # tablehead = '| package | maintainer | authors | licence | depends on |\n'
         # tableline = '| ------- | ---------- | ------- | ------- | ---------- |\n'
-        outstr = u''
-        outstr += ('\n'
-                   '## Install released packages\n'
-                   'See the [documentation]'
-                   '(https://github.com/LCAS/rosdistro/wiki'
-                   '#using-the-l-cas-repository-if-you-'
-                   'just-want-to-use-our-software) '
-                   'to enable the Ubuntu repositories to be ready to '
-                   'install binary releases. '
-                   'To install all packages documented here, '
-                   'simply run \n\n```\n'
-                   'sudo apt install <PACKAGENAME>\n```\n\n'
-                   'after having enabled the repositories.\n\n')
+        yield (u'\n'
+               '## Install released packages\n'
+               'See the [documentation]'
+               '(https://github.com/LCAS/rosdistro/wiki'
+               '#using-the-l-cas-repository-if-you-'
+               'just-want-to-use-our-software) '
+               'to enable the Ubuntu repositories to be ready to '
+               'install binary releases. '
+               'To install all packages documented here, '
+               'simply run \n\n```\n'
+               'sudo apt install <PACKAGENAME>\n```\n\n'
+               'after having enabled the repositories.\n\n')
         # outstr += ('\n'
         #            '## Cloning all repositories\n'
         #            'Copy the following code block into the file '
@@ -458,9 +1119,17 @@ class CacheAnalyser:
         # outstr += '\n```\n\n'
 
         for repo in sorted(repos):
-            outstr += self.generate_md_repo(repo)
+            for chunk in self.iter_md_repo(repo):
+                yield chunk
+
+    @profiler.timed('analyser.markdown')
+    def write_markdown_repos(self, out):
+        for chunk in self.iter_markdown_repos():
+            out.write(chunk)
 
-        return outstr
+    @profiler.timed('analyser.markdown')
+    def generate_markdown_repos(self):
+        return u''.join(self.iter_markdown_repos())
 
     def preamble(self):
         return ('This is an overview of repositories and packages '
@@ -483,7 +1152,10 @@ def main():
     )
     parser.add_argument(
         '--distro', '-d',
-        help='name of ROS distro, default: kinetic',
+        help='name of ROS distro, default: kinetic. Several distros can be '
+             'given space-separated; their markdown is then written to '
+             'repos-<distro>.md each, and "%%s" in the --write and --load '
+             'file names is replaced by the distro',
         default='kinetic'
     )
     parser.add_argument(
@@ -506,28 +1178,94 @@ def main():
         help='load previous data from a file. default: None',
         default=None
     )
+    parser.add_argument(
+        '--jobs', '-j',
+        help='number of repositories to analyse in parallel',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--xml-cache', '-x',
+        help='directory to cache release package.xml files in. default: None',
+        default=None
+    )
+    parser.add_argument(
+        '--incremental', '-i',
+        help='together with --load, only analyse repositories that changed '
+             'since the loaded data was written',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--fetch-mode', '-f',
+        help='how to fetch source repositories: a shallow "clone", or a '
+             '"sparse" partial clone of only the package.xml files',
+        choices=['clone', 'sparse'],
+        default='clone'
+    )
+    parser.add_argument(
+        '--mirror-dir', '-m',
+        help='directory of persistent bare mirrors of the source '
+             'repositories, replaces cloning. default: None',
+        default=None
+    )
+    parser.add_argument(
+        '--formats',
+        help='formats to render the dependency graph in',
+        nargs='+',
+        default=['svg', 'pdf', 'png']
+    )
+    parser.add_argument(
+        '--convert',
+        help='convert an old YAML data file (as written with --write by '
+             'older versions) to the current format and exit',
+        nargs=2,
+        metavar=('YAML_FILE', 'FILE'),
+        default=None
+    )
+    add_profile_argument(parser)
     args = parser.parse_args()
+    report_at_exit(args.profile_report)
+
+    if args.convert:
+        convert_yaml_snapshot(*args.convert)
+        return
 
     _tags = args.tags.split(' ') if len(args.tags)>0 else []
     _repo_whitelist = args.repo_whitelist.split(' ') if args.repo_whitelist else None
+    _distros = args.distro.split(' ')
+    for f in [args.write, args.load]:
+        if len(_distros) > 1 and f and '%s' not in f:
+            parser.error('with several distros, --write and --load file '
+                         'names need a "%s" placeholder')
     #print _orgas
-    ca = CacheAnalyser(
-        distro=args.distro, tags=_tags, repo_whitelist=_repo_whitelist)
-
-    if args.load:
-        ca.load(args.load)
-    else:
-        ca._analyse_repos()
-    if args.write:
-        ca.write(args.write)
-    dot = ca.generate_graph()
-    dot.layout(prog='dot')
-    dot.draw('repos-%s.svg' % args.distro)
-    dot.draw('repos-%s.pdf' % args.distro)
-    dot.draw('repos-%s.png' % args.distro)
-
-    print(ca.preamble())
-    print(ca.generate_markdown_repos())
+    session = AnalysisSession()
+    for distro in _distros:
+        ca = CacheAnalyser(
+            distro=distro, tags=_tags, repo_whitelist=_repo_whitelist,
+            jobs=args.jobs, xml_cache_dir=args.xml_cache,
+            fetch_mode=args.fetch_mode, mirror_dir=args.mirror_dir,
+            session=session)
+
+        if args.load:
+            ca.load(args.load.replace('%s', distro))
+            if args.incremental:
+                ca._analyse_changed_repos()
+        else:
+            ca._analyse_repos()
+        if args.write:
+            ca.write(args.write.replace('%s', distro))
+        dot = ca.generate_graph()
+        render(dot, 'repos-%s' % distro, args.formats)
+
+        if len(_distros) > 1:
+            with open('repos-%s.md' % distro, 'w') as f:
+                f.write(ca.preamble() + '\n')
+                ca.write_markdown_repos(f)
+                f.write('\n')
+        else:
+            print(ca.preamble())
+            ca.write_markdown_repos(sys.stdout)
+            print('')
 
 if __name__ == "__main__":
     basicConfig(level=INFO)
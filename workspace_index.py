@@ -0,0 +1,130 @@
+import json
+import os
+from logging import warning
+from os.path import dirname, exists, join, relpath
+from tempfile import mkstemp
+
+from catkin_pkg.package import parse_package
+
+from profiling import profiler
+
+# files that make the package crawler skip a directory
+IGNORE_MARKERS = ['CATKIN_IGNORE', 'COLCON_IGNORE', 'AMENT_IGNORE']
+# build, devel and install spaces and logs, never searched for packages
+BUILD_DIRS = ['build', 'devel', 'install', 'log']
+
+DEFAULT_INDEX_FILE = '.rosdepend_index.json'
+INDEX_VERSION = 1
+
+
+def find_workspace_packages(workspace):
+    # the package directories below workspace, found like the catkin package
+    # crawler does: ignored and hidden directories are skipped and packages
+    # are not descended into. Build spaces are skipped too, unless they are
+    # a package of their own.
+    for root, dirs, files in os.walk(workspace, followlinks=True):
+        if any([m in files for m in IGNORE_MARKERS]):
+            del dirs[:]
+            continue
+        if 'package.xml' in files:
+            del dirs[:]
+            yield root
+            continue
+        dirs[:] = [
+            d for d in dirs
+            if not d.startswith('.') and not (
+                d in BUILD_DIRS and
+                not exists(join(root, d, 'package.xml')))
+        ]
+
+
+def _package_info(pkg):
+    return {
+        'name': pkg.name,
+        'depends': list(set([str(d.name) for d in pkg.build_depends]
+                            + [str(d.name) for d in pkg.exec_depends])),
+        'description': pkg.description,
+        'licenses': pkg.licenses,
+        'authors': [a.name for a in pkg.authors],
+        'maintainers': [m.name for m in pkg.maintainers]
+    }
+
+
+class WorkspaceIndex:
+    # persistent index of the packages of a workspace, keyed by the path of
+    # their package.xml relative to the workspace. Each entry keeps the
+    # mtime and size of the package.xml it was parsed from, so only new and
+    # changed manifests are parsed again.
+
+    def __init__(self, workspace, index_file=None):
+        self._workspace = workspace
+        self._index_file = (index_file if index_file
+                            else join(workspace, DEFAULT_INDEX_FILE))
+        self._entries = self._load()
+        self.parsed = 0
+
+    def _load(self):
+        try:
+            with open(self._index_file, 'r') as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if index.get('version') != INDEX_VERSION:
+            return {}
+        return index['packages']
+
+    def _save(self):
+        # write to a temp file first, so an interrupted run never leaves a
+        # partial index behind
+        try:
+            fd, tmp_path = mkstemp(dir=dirname(os.path.abspath(
+                self._index_file)))
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'version': INDEX_VERSION,
+                    'packages': self._entries
+                }, f)
+            os.rename(tmp_path, self._index_file)
+        except (IOError, OSError) as e:
+            warning('could not write workspace index %s: %s'
+                    % (self._index_file, e))
+
+    @profiler.timed('workspace_index.update')
+    def update(self):
+        entries = {}
+        changed = False
+        for path in find_workspace_packages(self._workspace):
+            rel = relpath(path, self._workspace)
+            xml = join(path, 'package.xml')
+            st = os.stat(xml)
+            e = self._entries.get(rel)
+            hit = (e is not None and e['mtime'] == st.st_mtime and
+                   e['size'] == st.st_size)
+            profiler.cache('workspace_index', hit)
+            if not hit:
+                e = {
+                    'mtime': st.st_mtime,
+                    'size': st.st_size,
+                    'package': _package_info(parse_package(xml))
+                }
+                self.parsed += 1
+                changed = True
+            entries[rel] = e
+        if changed or set(entries) != set(self._entries):
+            self._entries = entries
+            self._save()
+
+    def packages(self):
+        # package name -> package info, with the path of the package
+        self.update()
+        result = {}
+        for rel, e in self._entries.items():
+            info = dict(e['package'])
+            if info['name'] in result:
+                raise RuntimeError(
+                    'Multiple packages found with the same name "%s": %s, %s'
+                    % (info['name'], result[info['name']]['path'],
+                       join(self._workspace, rel)))
+            info['path'] = join(self._workspace, rel)
+            result[info['name']] = info
+        return result